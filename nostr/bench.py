@@ -0,0 +1,422 @@
+#!/usr/bin/python3
+'''
+Micro-benchmarks for the nostr utilities.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import argparse
+import os
+import time
+
+def report(name, count, elapsed):
+    print(f'{name:40} {count / elapsed:12.1f} /s  ({elapsed:.3f}s)')
+
+def make_events(count, authors=100, tags=1):
+    '''
+    Make `count` signed text notes by `authors` random keys.
+    '''
+    from nostr.key import NostrKey
+    keys = [NostrKey(os.urandom(32).hex()) for _ in range(authors)]
+    events = []
+    for i in range(count):
+        key = keys[i % authors]
+        event = {
+            'pubkey': key.public_key,
+            'created_at': 1731409010 + i,
+            'kind': 1,
+            'tags': [['t', f'tag{j}'] for j in range(tags)],
+            'content': f'benchmark message {i}',
+        }
+        key.sign_event(event)
+        events.append(event)
+    return events
+
+def bench_verify(args):
+    from nostr.key import verify_event, verify_events, PUBKEY_CACHE, VERIFIED_CACHE
+    events = make_events(args.count)
+
+    def clear_caches():
+        PUBKEY_CACHE.clear()
+        VERIFIED_CACHE.clear()
+
+    clear_caches()
+    start = time.perf_counter()
+    assert all(verify_event(event) for event in events)
+    report('verify_event loop', len(events), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    assert all(verify_event(event) for event in events)
+    report('verify_event loop (seen before)', len(events), time.perf_counter() - start)
+    print(f'pubkey cache: {PUBKEY_CACHE.hits} hits {PUBKEY_CACHE.misses} misses')
+    print(f'verified cache: {VERIFIED_CACHE.hits} hits {VERIFIED_CACHE.misses} misses')
+
+    clear_caches()
+    start = time.perf_counter()
+    assert all(verify_events(events, processes=1))
+    report('verify_events (1 process)', len(events), time.perf_counter() - start)
+
+    clear_caches()
+    processes = max(os.cpu_count(), 2)
+    start = time.perf_counter()
+    assert all(verify_events(events, processes=processes))
+    report(f'verify_events ({processes} processes)', len(events), time.perf_counter() - start)
+
+def bench_hash(args):
+    import hashlib
+    import json
+    from nostr.key import compute_event_hash
+
+    def reference(event):
+        data = [0, event['pubkey'], event['created_at'], event['kind'], event['tags'], event['content']]
+        data_str = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+        return hashlib.sha256(data_str.encode()).hexdigest()
+
+    for tags in [1, 300]:
+        event = {
+            'pubkey': 'b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816',
+            'created_at': 1731409010,
+            'kind': 2003,
+            'tags': [['file', f'bitcoin-28.0/bitcoin-28.0-{i}-x86_64-linux-gnu.tar.gz', str(48000000 + i)] for i in range(tags)],
+            'content': 'Bitcoin Core 28.0 🧲',
+        }
+        assert compute_event_hash(event) == reference(event)
+        for name, f in [('json.dumps', reference), ('compute_event_hash', compute_event_hash)]:
+            start = time.perf_counter()
+            for _ in range(args.count):
+                f(event)
+            report(f'{name} ({tags} tags)', args.count, time.perf_counter() - start)
+
+def bench_pow(args):
+    from nostr.key import mine_event
+    event = {
+        'pubkey': 'b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816',
+        'created_at': 1731409010,
+        'kind': 1,
+        'tags': [],
+        'content': 'proof of work benchmark',
+    }
+    # unreachable difficulty, so this measures the hash rate until the deadline
+    for processes in sorted({1, os.cpu_count()}):
+        result = mine_event(event, 256, timeout=2, processes=processes)
+        report(f'mine_event ({processes} processes)', result.hashes, result.elapsed)
+        print(f'best difficulty {result.difficulty} bits (nonce {result.nonce})')
+
+def bench_bech32(args):
+    from nostr import bech32
+    datas = [bech32.convertbits(os.urandom(32), 8, 5) for _ in range(args.count)]
+    strings = [bech32.bech32_encode('npub', data, bech32.Encoding.BECH32) for data in datas]
+
+    def reference_verify(bech):
+        hrp, data = bech[:4], [bech32.CHARSET.find(x) for x in bech[5:]]
+        return bech32.bech32_polymod(bech32.bech32_hrp_expand(hrp) + data) == 1
+
+    start = time.perf_counter()
+    assert all(reference_verify(bech) for bech in strings)
+    report('reference checksum loop', len(strings), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    assert all(bech32.bech32_decode(bech)[0] for bech in strings)
+    report('bech32_decode loop', len(strings), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    assert all(hrp for hrp, _, _ in bech32.bech32_decode_many(strings))
+    report(f'bech32_decode_many (numpy: {bech32.numpy is not None})', len(strings), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for data in datas:
+        bech32.bech32_encode('npub', data, bech32.Encoding.BECH32)
+    report('bech32_encode loop', len(strings), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    bech32.bech32_encode_many('npub', datas, bech32.Encoding.BECH32)
+    report(f'bech32_encode_many (numpy: {bech32.numpy is not None})', len(strings), time.perf_counter() - start)
+
+    # small batches, as when decoding the embeds of a single note
+    for size in [1, 8]:
+        start = time.perf_counter()
+        for i in range(0, len(strings), size):
+            bech32.bech32_decode_many(strings[i:i + size])
+        report(f'bech32_decode_many in batches of {size}', len(strings), time.perf_counter() - start)
+
+def bench_convertbits(args):
+    from nostr import bech32
+    from nostr.util import encode_nevent, decode
+    for size in [32, 1024]:
+        data = os.urandom(size)
+        values = bech32.convertbits_bytes(data, 8, 5)
+        for name, f in [
+                ('convertbits 8->5', lambda: bech32.convertbits(data, 8, 5)),
+                ('convertbits_bytes 8->5', lambda: bech32.convertbits_bytes(data, 8, 5)),
+                ('convertbits 5->8', lambda: bech32.convertbits(values, 5, 8, False)),
+                ('convertbits_bytes 5->8', lambda: bech32.convertbits_bytes(values, 5, 8, False))]:
+            start = time.perf_counter()
+            for _ in range(args.count):
+                f()
+            report(f'{name} ({size} bytes)', args.count, time.perf_counter() - start)
+
+    event_id = os.urandom(32).hex()
+    relays = [f'wss://relay{i}.example.com' for i in range(20)]
+    for relay_count in [1, 20]:
+        nevent = encode_nevent(event_id, relays[:relay_count], author=event_id, kind=1)
+        start = time.perf_counter()
+        for _ in range(args.count):
+            encode_nevent(event_id, relays[:relay_count], author=event_id, kind=1)
+        report(f'encode_nevent ({len(nevent)} chars)', args.count, time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(args.count):
+            decode(nevent)
+        report(f'decode nevent ({len(nevent)} chars)', args.count, time.perf_counter() - start)
+
+def bench_nip19(args):
+    import random
+    from nostr.util import encode_npub, encode_nprofile, decode, decode_many, DECODE_CACHE
+    # mention-heavy content: a small set of profiles mentioned over and over
+    profiles = [encode_npub(os.urandom(32)) for _ in range(500)] + \
+               [encode_nprofile(os.urandom(32), [f'wss://relay{i}.example.com']) for i in range(500)]
+    embeds = random.Random(0).choices(profiles, k=args.count)
+
+    start = time.perf_counter()
+    for embed in embeds:
+        decode(embed)
+    report('decode loop', len(embeds), time.perf_counter() - start)
+
+    DECODE_CACHE.clear()
+    start = time.perf_counter()
+    decode_many(embeds)
+    report('decode_many', len(embeds), time.perf_counter() - start)
+    print(f'decode cache: {DECODE_CACHE.hits} hits {DECODE_CACHE.misses} misses')
+
+def bench_filters(args):
+    import random
+    from nostr.util import FilterIndex, compile_filter
+    rng = random.Random(0)
+    authors = [os.urandom(32).hex() for _ in range(5000)]
+    filters = []
+    for i in range(10000):
+        r = rng.random()
+        if r < 0.6: # follow lists
+            filters.append({'authors': rng.sample(authors, 5), 'kinds': [1, 6]})
+        elif r < 0.9: # mentions
+            filters.append({'#p': [rng.choice(authors)], 'kinds': [1]})
+        elif r < 0.99: # replaceable events of one author
+            filters.append({'kinds': [30023], 'authors': [rng.choice(authors)]})
+        else: # firehose-ish
+            filters.append({'kinds': [rng.choice([0, 3, 2003])]})
+    events = [{
+        'id': os.urandom(32).hex(),
+        'pubkey': rng.choice(authors),
+        'created_at': 1731409000 + i,
+        'kind': rng.choice([0, 1, 1, 1, 3, 6, 2003, 30023]),
+        'tags': [['p', rng.choice(authors)] for _ in range(rng.randrange(4))] + [['t', 'nostr']],
+        'content': '',
+    } for i in range(args.count)]
+
+    index = FilterIndex()
+    start = time.perf_counter()
+    for key, filt in enumerate(filters):
+        index.add(key, filt)
+    report(f'FilterIndex.add ({len(filters)} filters)', len(filters), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    matches = sum(len(index.match(event)) for event in events)
+    report(f'FilterIndex.match ({len(filters)} filters)', len(events), time.perf_counter() - start)
+
+    compiled = [compile_filter(filt) for filt in filters]
+    sample = events[:max(len(events) // 100, 1)]
+    start = time.perf_counter()
+    naive = sum(1 for event in sample for filt in compiled if filt.matches(event))
+    report(f'linear scan ({len(filters)} filters)', len(sample), time.perf_counter() - start)
+    assert naive == sum(len(index.match(event)) for event in sample)
+    print(f'{matches / len(events):.2f} matching filters per event')
+
+def bench_memory(args):
+    import gc
+    import json
+    import random
+    import tracemalloc
+    from nostr.event import Event
+    rng = random.Random(0)
+    authors = [os.urandom(32).hex() for _ in range(1000)]
+    hashtags = ['nostr', 'bitcoin', 'music', 'photography', 'news']
+
+    def make_dicts():
+        # the shape of events as received from a relay: fresh objects, unsigned
+        # random sigs since only the size matters here
+        return [json.loads(json.dumps({
+            'id': os.urandom(32).hex(),
+            'pubkey': rng.choice(authors),
+            'created_at': 1731409000 + i,
+            'kind': 1,
+            'tags': [['p', rng.choice(authors)], ['t', rng.choice(hashtags)]],
+            'content': f'message {i}',
+            'sig': os.urandom(64).hex(),
+        })) for i in range(args.count)]
+
+    for name, convert in [('dict', None), ('Event', Event.from_dict)]:
+        gc.collect()
+        tracemalloc.start()
+        events = make_dicts()
+        if convert is not None:
+            events = [convert(event) for event in events]
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name:40} {size / len(events):12.1f} bytes/event  ({size / len(events) * 1e6 / 2**20:.0f} MiB per million)')
+        del events
+
+def bench_codec(args):
+    import json
+    import random
+    from nostr.codec import CODECS, decode_message
+    from nostr.event import Event
+    from nostr.key import compute_event_hash
+    rng = random.Random(0)
+    authors = [os.urandom(32).hex() for _ in range(1000)]
+
+    def make_event(i):
+        # mix of kinds roughly as seen on a busy relay
+        r = rng.random()
+        if r < 0.5: # text note, with mentions and non-ASCII
+            kind, content = 1, f'gm nostr! ☕️ {"lorem ipsum " * rng.randrange(1, 40)}#{i}'
+            tags = [['e', os.urandom(32).hex(), 'wss://relay.example.com', 'root']] + \
+                   [['p', rng.choice(authors)] for _ in range(rng.randrange(3))]
+        elif r < 0.85: # reaction
+            kind, content = 7, '+'
+            tags = [['e', os.urandom(32).hex()], ['p', rng.choice(authors)]]
+        elif r < 0.95: # profile metadata, JSON in content
+            kind, content = 0, json.dumps({'name': f'user{i}', 'about': 'über \n nostr', 'picture': 'https://example.com/a.png'})
+            tags = []
+        else: # contact list
+            kind, content = 3, ''
+            tags = [['p', author] for author in rng.sample(authors, rng.randrange(50, 500))]
+        return {'id': os.urandom(32).hex(), 'pubkey': rng.choice(authors), 'created_at': 1731409000 + i,
+                'kind': kind, 'tags': tags, 'content': content, 'sig': os.urandom(64).hex()}
+
+    events = [make_event(i) for i in range(args.count)]
+    frames = [json.dumps(['EVENT', 'sub', event]) for event in events]
+    size = sum(len(frame.encode()) for frame in frames) / 2**20
+    print(f'{len(frames)} frames, {size:.1f} MiB')
+    hashes = [compute_event_hash(event) for event in events[:1000]]
+
+    for codec in CODECS.values():
+        start = time.perf_counter()
+        decoded = [codec.loads(frame) for frame in frames]
+        elapsed = time.perf_counter() - start
+        report(f'{codec.name} loads', len(frames), elapsed)
+        assert [compute_event_hash(message[2]) for message in decoded[:1000]] == hashes
+
+        start = time.perf_counter()
+        for frame in frames:
+            decode_message(frame, codec, Event)
+        report(f'{codec.name} decode_message to Event', len(frames), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for message in decoded:
+            codec.dumps(message)
+        report(f'{codec.name} dumps', len(frames), time.perf_counter() - start)
+        print(f'{codec.name} loads: {size / elapsed:.1f} MiB/s')
+
+def bench_bencode(args):
+    import tracemalloc
+    import bencode
+    # large multi-file torrent: `count` files, 20 bytes of piece hash each
+    data = bencode.bencode({
+        b'announce': b'udp://tracker.example.com:1337',
+        b'info': {
+            b'name': b'benchmark',
+            b'piece length': 262144,
+            b'pieces': os.urandom(20 * args.count),
+            b'files': [{b'length': 262144, b'path': [b'dir', f'file{i}'.encode()]} for i in range(args.count)],
+        },
+    })
+    print(f'torrent size {len(data) / 2**20:.1f} MiB')
+    for name, decode in [('bdecode', bencode.bdecode), ('bdecode_lazy', bencode.bdecode_lazy)]:
+        start = time.perf_counter()
+        len(decode(data)[b'info'][b'pieces'])
+        report(f'{name} (torrents)', 1, time.perf_counter() - start)
+        tracemalloc.start()
+        len(decode(data)[b'info'][b'pieces'])
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f'{name} peak memory {peak / 2**20:.1f} MiB')
+
+def bench_payload(args):
+    import hashlib
+    import random
+    import tempfile
+    import torrent
+    rng = random.Random(0)
+    piece_length = 1 << 20
+    block = os.urandom(piece_length)
+    with tempfile.TemporaryDirectory(dir=args.payload_dir) as base:
+        # files of uneven sizes, so that most pieces span file boundaries
+        os.makedirs(os.path.join(base, 'payload'))
+        files = []
+        remaining = args.payload_size << 20
+        pieces = []
+        piece = hashlib.sha1()
+        filled = 0
+        while remaining > 0:
+            size = min(rng.randrange(1, 256 << 20), remaining)
+            name = f'file{len(files)}'
+            files.append({b'length': size, b'path': [name.encode()]})
+            remaining -= size
+            with open(os.path.join(base, 'payload', name), 'wb') as f:
+                while size:
+                    n = min(size, piece_length - filled)
+                    data = block[filled:filled + n]
+                    f.write(data)
+                    piece.update(data)
+                    filled += n
+                    size -= n
+                    if filled == piece_length:
+                        pieces.append(piece.digest())
+                        piece = hashlib.sha1()
+                        filled = 0
+        if filled:
+            pieces.append(piece.digest())
+        info = {b'name': b'payload', b'piece length': piece_length, b'pieces': b''.join(pieces), b'files': files}
+        print(f'{args.payload_size} MiB payload in {len(files)} files, {len(pieces)} pieces')
+
+        for processes in [1, max(os.cpu_count(), 2)]:
+            result = torrent.verify_payload(info, base, processes=processes)
+            assert not result.bad
+            print(f'verify_payload ({processes} processes) {result.rate / 2**20:12.1f} MiB/s  ({result.elapsed:.3f}s)')
+
+BENCHMARKS = {
+    'verify': bench_verify,
+    'hash': bench_hash,
+    'pow': bench_pow,
+    'bech32': bench_bech32,
+    'convertbits': bench_convertbits,
+    'nip19': bench_nip19,
+    'filters': bench_filters,
+    'memory': bench_memory,
+    'codec': bench_codec,
+    'bencode': bench_bencode,
+    'payload': bench_payload,
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run nostr micro-benchmarks.',
+    )
+    parser.add_argument('-n', dest='count', type=int, default=20000, help="Number of items to process")
+    parser.add_argument('--payload-size', type=int, default=4096, help="Size of the synthetic torrent payload in MiB")
+    parser.add_argument('--payload-dir', help="Directory to write the synthetic torrent payload to (default: system temporary directory)")
+    parser.add_argument('benchmark', nargs='*', help="Benchmarks to run (default: all)")
+
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error(f'unknown benchmark {name}, choose from: {", ".join(BENCHMARKS)}')
+    return args
+
+def main():
+    args = parse_args()
+    for name in args.benchmark or BENCHMARKS:
+        print(f'[{name}]')
+        BENCHMARKS[name](args)
+
+if __name__ == '__main__':
+    main()
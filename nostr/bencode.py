@@ -10,6 +10,9 @@
 
 # Written by Petru Paler
 # Ported to python 3 by W J van der Laan
+import collections.abc
+import mmap
+import re
 
 class BTFailure(Exception):
     pass
@@ -72,6 +75,163 @@ def bdecode(x):
         raise BTFailure("invalid bencoded value (data after valid prefix)")
     return r
 
+# Zero-copy decoding. The input is validated completely up front, with the
+# same checks in the same order as the functions above, so that exactly the
+# same inputs are rejected. Values are then decoded from the buffer on
+# access.
+
+_COLON = re.compile(b':')
+_END = re.compile(b'e')
+
+def _find(x, pattern, f):
+    # like x.index(), but for any buffer (bytes, mmap, memoryview)
+    m = pattern.search(x, f)
+    if m is None:
+        raise ValueError
+    return m.start()
+
+def _int(x, f, newf):
+    return int(bytes(x[f:newf]))
+
+def scan_int(x, f, ends):
+    f += 1
+    newf = _find(x, _END, f)
+    _int(x, f, newf)
+    if x[f] == ord('-'):
+        if x[f + 1] == ord('0'):
+            raise ValueError
+    elif x[f] == ord('0') and newf != f+1:
+        raise ValueError
+    return newf+1
+
+def scan_string(x, f, ends):
+    colon = _find(x, _COLON, f)
+    n = _int(x, f, colon)
+    if x[f] == ord('0') and colon != f+1:
+        raise ValueError
+    return colon+1+n
+
+def scan_list(x, f, ends):
+    start, f = f, f+1
+    while x[f] != ord('e'):
+        f = scan_func[x[f]](x, f, ends)
+    ends[start] = f + 1
+    return f + 1
+
+def scan_dict(x, f, ends):
+    start, f = f, f+1
+    while x[f] != ord('e'):
+        f = scan_string(x, f, ends)
+        f = scan_func[x[f]](x, f, ends)
+    ends[start] = f + 1
+    return f + 1
+
+scan_func = {ord('l'): scan_list, ord('d'): scan_dict, ord('i'): scan_int}
+for c in b'0123456789':
+    scan_func[c] = scan_string
+
+def _skip(x, f, ends):
+    # end of the (already validated) value at f
+    end = ends.get(f)
+    if end is None:
+        end = scan_func[x[f]](x, f, ends)
+    return end
+
+def _lazy_value(x, f, ends):
+    c = x[f]
+    if c == ord('d'):
+        return LazyDict(x, f, ends)
+    if c == ord('l'):
+        r, f, end = [], f+1, ends[f] - 1
+        while f < end:
+            r.append(_lazy_value(x, f, ends))
+            f = _skip(x, f, ends)
+        return r
+    if c == ord('i'):
+        newf = _find(x, _END, f+1)
+        return _int(x, f+1, newf)
+    colon = _find(x, _COLON, f)
+    colon += 1
+    return x[colon:colon+_int(x, f, colon-1)]
+
+class LazyDict(collections.abc.Mapping):
+    '''
+    Read-only bencoded dictionary that decodes its values when they are
+    first accessed. Keys are bytes.
+    '''
+    def __init__(self, x, f, ends):
+        self._x = x
+        self._ends = ends
+        self._offsets = {}
+        self._values = {}
+        f, end = f+1, ends[f] - 1
+        while f < end:
+            colon = _find(x, _COLON, f) + 1
+            f = colon+_int(x, f, colon-1)
+            self._offsets[bytes(x[colon:f])] = f
+            f = _skip(x, f, ends)
+
+    def span(self, key):
+        '''
+        Return (start, end) offsets of the bencoded value of key in the
+        buffer.
+        '''
+        f = self._offsets[key]
+        return (f, _skip(self._x, f, self._ends))
+
+    def raw(self, key):
+        '''
+        Return the bencoded value of key exactly as it appears in the buffer,
+        as a memoryview.
+        '''
+        start, end = self.span(key)
+        return self._x[start:end]
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        value = self._values[key] = _lazy_value(self._x, self._offsets[key], self._ends)
+        return value
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __repr__(self):
+        return f'LazyDict({list(self._offsets)!r})'
+
+def bdecode_lazy(x):
+    '''
+    Decode bencoded data from a buffer (bytes, mmap, memoryview) without
+    copying it. Strings are returned as memoryview slices of the buffer,
+    dictionaries as LazyDict. Raises BTFailure for the same inputs as bdecode.
+    '''
+    x = memoryview(x).cast('B')
+    ends = {}
+    try:
+        l = scan_func[x[0]](x, 0, ends)
+    except (IndexError, KeyError, ValueError):
+        raise BTFailure("not a valid bencoded string")
+    if l != len(x):
+        raise BTFailure("invalid bencoded value (data after valid prefix)")
+    return _lazy_value(x, 0, ends)
+
+def bdecode_file(path):
+    '''
+    Decode a bencoded file with bdecode_lazy over a read-only memory map, so
+    that only the parts that are used are read from disk.
+    '''
+    with open(path, 'rb') as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return bdecode_lazy(b'')
+    return bdecode_lazy(m)
+
 class Bencached(object):
     def __init__(self, s):
         self.bencoded = s
@@ -5,11 +5,12 @@ Publish music playing events from cmus to nostr.
 # W.J. van der Laan 2024
 # SPDX-License-Identifier: MIT
 # pip install pycmus secp256k1 websocket-client
+import asyncio
 import pathlib
 import time
 
 from nostr.key import NostrKey
-from nostr.client import send_to_relays
+from nostr.client import RelayPool
 
 import pycmus.remote
 
@@ -82,9 +83,11 @@ def make_music_status_event(key, description):
     }
     return event
 
-def main():
+async def main():
     from auth.musickey import private_key, RELAYS
     key = NostrKey(private_key)
+    # keep relay connections open between events
+    pool = RelayPool(RELAYS)
     prev_description = None
     while True:
         try:
@@ -99,11 +102,13 @@ def main():
             event = make_music_status_event(key, description)
             key.sign_event(event)
             print(event)
-            send_to_relays(RELAYS, event)
+            for relay_url, result in (await pool.publish(event)).items():
+                if not result.accepted:
+                    print(f'Failed to send to {relay_url}: {result.message}')
 
             prev_description = description
 
-        time.sleep(POLL_TIME)
+        await asyncio.sleep(POLL_TIME)
 
 if __name__ == '__main__':
-    main()
+    asyncio.run(main())
@@ -21,15 +21,50 @@
 """Reference implementation for Bech32/Bech32m and segwit addresses."""
 
 
+import base64
+import functools
+import re
 from enum import Enum
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Encoding(Enum):
     """Enumeration type to list the various supported encodings."""
     BECH32 = 1
     BECH32M = 2
 
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+# Minimum number of strings of the same HRP and length to process with NumPy
+# in the *_many functions. Setting up the arrays costs about as much as
+# checksumming 50 strings one by one.
+VECTORIZE_MIN = 64
 BECH32M_CONST = 0x2bc830a3
+GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+
+# Generator terms to XOR in for each possible 5-bit top value.
+POLYMOD_TABLE = [0] * 32
+for _top in range(32):
+    for _i in range(5):
+        if (_top >> _i) & 1:
+            POLYMOD_TABLE[_top] ^= GENERATOR[_i]
+
+# Translation table from (ASCII) bech32 characters to 5-bit values, 0xff for
+# characters not in the charset.
+CHARSET_REV = bytes(CHARSET.index(chr(c)) if chr(c) in CHARSET else 0xff for c in range(256))
+INVALID_CHARS_RE = re.compile('[^\x21-\x7e]')
+# Translation table from 5-bit values to bech32 characters.
+CHARSET_BYTES = CHARSET.encode().ljust(256, b'?')
+# Translation table from the RFC 4648 base32 alphabet (as produced by
+# base64.b32encode) to 5-bit values.
+B32_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+B32_TO_VALUES = bytes(B32_ALPHABET.index(c) if c in B32_ALPHABET else 0xff for c in range(256))
+# Translation table from 5-bit values to digits for int(..., 32). Values that
+# are not 5-bit map to an invalid digit.
+VALUES_TO_DIGITS = b'0123456789abcdefghijklmnopqrstuv'.ljust(256, b'!')
 
 def bech32_polymod(values):
     """Internal function that computes the Bech32 checksum."""
@@ -48,46 +83,154 @@ def bech32_hrp_expand(hrp):
     return [ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp]
 
 
-def bech32_verify_checksum(hrp, data):
-    """Verify a checksum given HRP and converted data characters."""
-    const = bech32_polymod(bech32_hrp_expand(hrp) + data)
+# bech32_polymod and bech32_hrp_expand above are the reference
+# implementation; the functions below compute the same checksum with a lookup
+# table, starting from a cached state for the HRP instead of concatenating
+# lists.
+
+def polymod_update(chk, values):
+    """Table-driven bech32_polymod, continuing from state chk."""
+    table = POLYMOD_TABLE
+    for value in values:
+        chk = ((chk & 0x1ffffff) << 5) ^ value ^ table[chk >> 25]
+    return chk
+
+@functools.lru_cache(maxsize=256)
+def hrp_polymod(hrp):
+    """Checksum state after processing the expanded HRP."""
+    return bech32_polymod(bech32_hrp_expand(hrp))
+
+def spec_from_const(const):
     if const == 1:
         return Encoding.BECH32
     if const == BECH32M_CONST:
         return Encoding.BECH32M
     return None
 
+def checksum_from_polymod(polymod, spec):
+    """Checksum values from the state after data and six zeros."""
+    polymod ^= BECH32M_CONST if spec == Encoding.BECH32M else 1
+    return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+
+def bech32_verify_checksum(hrp, data):
+    """Verify a checksum given HRP and converted data characters."""
+    return spec_from_const(polymod_update(hrp_polymod(hrp), data))
+
 def bech32_create_checksum(hrp, data, spec):
     """Compute the checksum values given HRP and data."""
-    values = bech32_hrp_expand(hrp) + data
-    const = BECH32M_CONST if spec == Encoding.BECH32M else 1
-    polymod = bech32_polymod(values + [0, 0, 0, 0, 0, 0]) ^ const
-    return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    polymod = polymod_update(polymod_update(hrp_polymod(hrp), data), (0, 0, 0, 0, 0, 0))
+    return checksum_from_polymod(polymod, spec)
 
 
 def bech32_encode(hrp, data, spec):
     """Compute a Bech32 string given HRP and data values."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        if data and max(data) > 31:
+            raise ValueError('data values must be 5-bit')
+        combined = bytes(data) + bytes(bech32_create_checksum(hrp, data, spec))
+        return hrp + '1' + combined.translate(CHARSET_BYTES).decode()
     combined = data + bech32_create_checksum(hrp, data, spec)
     return hrp + '1' + ''.join([CHARSET[d] for d in combined])
 
-def bech32_decode(bech, max_len=90):
-    """Validate a Bech32/Bech32m string, and determine HRP and data."""
-    if ((any(ord(x) < 33 or ord(x) > 126 for x in bech)) or
+def _bech32_split(bech, max_len):
+    """Check the characters and length of a Bech32 string, and split it into
+    HRP and data values (as bytes). Returns None if invalid."""
+    if (INVALID_CHARS_RE.search(bech) or
             (bech.lower() != bech and bech.upper() != bech)):
-        return (None, None, None)
+        return None
     bech = bech.lower()
     pos = bech.rfind('1')
     if pos < 1 or pos + 7 > len(bech) or len(bech) > max_len:
+        return None
+    data = bech[pos+1:].encode().translate(CHARSET_REV)
+    if 0xff in data:
+        return None
+    return (bech[:pos], data)
+
+def bech32_decode_bytes(bech, max_len=90):
+    """Like bech32_decode, but return the data values as bytes."""
+    split = _bech32_split(bech, max_len)
+    if split is None:
         return (None, None, None)
-    if not all(x in CHARSET for x in bech[pos+1:]):
-        return (None, None, None)
-    hrp = bech[:pos]
-    data = [CHARSET.find(x) for x in bech[pos+1:]]
+    hrp, data = split
     spec = bech32_verify_checksum(hrp, data)
     if spec is None:
         return (None, None, None)
     return (hrp, data[:-6], spec)
 
+def bech32_decode(bech, max_len=90):
+    """Validate a Bech32/Bech32m string, and determine HRP and data."""
+    hrp, data, spec = bech32_decode_bytes(bech, max_len)
+    if hrp is None:
+        return (None, None, None)
+    return (hrp, list(data), spec)
+
+def _polymod_many(chk, values):
+    """Vectorized polymod_update over the rows of a 2D uint8 array, starting
+    from state(s) chk."""
+    table = numpy.array(POLYMOD_TABLE, dtype=numpy.uint32)
+    chk = numpy.broadcast_to(numpy.uint32(chk), values.shape[:1]).copy()
+    for column in values.T:
+        chk = ((chk & 0x1ffffff) << 5) ^ column ^ table[chk >> 25]
+    return chk
+
+def bech32_decode_many(bechs, max_len=90):
+    """Validate and decode many Bech32/Bech32m strings. Returns a list of
+    (hrp, data, spec) tuples, like bech32_decode for each string.
+
+    If NumPy is available the checksums of at least VECTORIZE_MIN strings with
+    the same HRP and length are verified in one vectorized pass."""
+    if numpy is None or len(bechs) < VECTORIZE_MIN:
+        return [bech32_decode(bech, max_len) for bech in bechs]
+    rv = []
+    groups = {}
+    for bech in bechs:
+        split = _bech32_split(bech, max_len)
+        if split is not None:
+            groups.setdefault((split[0], len(split[1])), []).append(len(rv))
+        rv.append(split)
+    for (hrp, length), indices in groups.items():
+        if len(indices) < VECTORIZE_MIN:
+            consts = [polymod_update(hrp_polymod(hrp), rv[i][1]) for i in indices]
+        else:
+            values = numpy.frombuffer(b''.join(rv[i][1] for i in indices), dtype=numpy.uint8).reshape(len(indices), length)
+            consts = _polymod_many(hrp_polymod(hrp), values).tolist()
+        for i, const in zip(indices, consts):
+            spec = spec_from_const(const)
+            rv[i] = (hrp, list(rv[i][1][:-6]), spec) if spec is not None else None
+    return [item if item is not None else (None, None, None) for item in rv]
+
+def bech32_encode_many(hrp, datas, spec):
+    """Compute Bech32 strings for many data value lists with the same HRP.
+
+    If NumPy is available the checksums for at least VECTORIZE_MIN data of the
+    same length are computed in one vectorized pass."""
+    datas = [bytes(data) for data in datas]
+    if numpy is None or len(datas) < VECTORIZE_MIN:
+        return [bech32_encode(hrp, list(data), spec) for data in datas]
+    if any(max(data, default=0) > 31 for data in datas):
+        raise ValueError('data values must be 5-bit')
+    groups = {}
+    for i, data in enumerate(datas):
+        groups.setdefault(len(data), []).append(i)
+    rv = [None] * len(datas)
+    const = BECH32M_CONST if spec == Encoding.BECH32M else 1
+    charset = CHARSET.encode()
+    for length, indices in groups.items():
+        if len(indices) < VECTORIZE_MIN:
+            for i in indices:
+                rv[i] = bech32_encode(hrp, list(datas[i]), spec)
+            continue
+        values = numpy.zeros((len(indices), length + 6), dtype=numpy.uint8)
+        values[:, :length] = numpy.frombuffer(b''.join(datas[i] for i in indices), dtype=numpy.uint8).reshape(len(indices), length)
+        polymods = _polymod_many(hrp_polymod(hrp), values) ^ const
+        for j in range(6):
+            values[:, length + j] = (polymods >> (5 * (5 - j))) & 31
+        encoded = numpy.frombuffer(charset, dtype=numpy.uint8)[values]
+        for i, row in zip(indices, encoded):
+            rv[i] = hrp + '1' + row.tobytes().decode()
+    return rv
+
 def convertbits(data, frombits, tobits, pad=True):
     """General power-of-2 base conversion."""
     acc = 0
@@ -111,6 +254,33 @@ def convertbits(data, frombits, tobits, pad=True):
     return ret
 
 
+def convertbits_bytes(data, frombits, tobits, pad=True):
+    """Like convertbits, but take any bytes-like object and return bytes.
+
+    Conversion from 8 to 5 bits (with padding), as used for bech32 encoding,
+    goes through the base32 codec. Conversion from 5 to 8 bits (without
+    padding), as used for decoding, parses the values as one base-32 number."""
+    if frombits == 8 and tobits == 5 and pad:
+        return base64.b32encode(data).rstrip(b'=').translate(B32_TO_VALUES)
+    if frombits == 5 and tobits == 8 and not pad:
+        leftover = len(data) * 5 % 8
+        if leftover >= 5:
+            return None
+        if not data:
+            return b''
+        try:
+            n = int(bytes(data).translate(VALUES_TO_DIGITS), 32)
+        except ValueError: # value out of range
+            return None
+        if n & ((1 << leftover) - 1): # non-zero padding
+            return None
+        return (n >> leftover).to_bytes(len(data) * 5 // 8, 'big')
+    if tobits > 8:
+        raise ValueError('cannot represent values of more than 8 bits as bytes')
+    rv = convertbits(data, frombits, tobits, pad)
+    return bytes(rv) if rv is not None else None
+
+
 def decode(hrp, addr):
     """Decode a segwit address."""
     hrpgot, data, spec = bech32_decode(addr)
@@ -3,20 +3,569 @@ Nostr relay client utilties.
 '''
 # W.J. van der Laan 2024
 # SPDX-License-Identifier: MIT
-import json
+import asyncio
+import collections
+import concurrent.futures
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+
 import websocket
 
-def send_to_relays(relays, event):
+from .codec import decode_message, get_codec
+from .metrics import Metrics
+from .outbox import Outbox, is_final
+
+# Timeout for opening a connection to a relay, in seconds.
+CONNECT_TIMEOUT = 10
+# Minimum and maximum delay between reconnection attempts, in seconds.
+BACKOFF_MIN = 1
+BACKOFF_MAX = 300
+# Default time to wait for relays to acknowledge an event, in seconds.
+PUBLISH_TIMEOUT = 10
+# Default number of unacknowledged events per relay when publishing in bulk.
+PUBLISH_WINDOW = 32
+# Default number of consecutive timeouts after which bulk publishing gives up
+# on a relay.
+PUBLISH_MAX_TIMEOUTS = 3
+# Default number of received messages buffered per subscription.
+SUBSCRIPTION_QUEUE = 1024
+# Default number of recent event ids remembered per subscription to drop
+# duplicates received from different relays.
+DEDUPE_SIZE = 100000
+
+class PublishResult(NamedTuple):
     '''
-    Send event to relays.
+    Outcome of publishing an event to one relay. `accepted` is None if the
+    relay did not reply before the deadline, `rtt` is the time from sending
+    the event to receiving the OK in seconds.
+    '''
+    accepted: Optional[bool]
+    message: str
+    rtt: Optional[float] = None
+
+def _set_result(fut, result):
+    if not fut.done():
+        fut.set_result(result)
+
+class Relay:
+    '''
+    Persistent connection to a single relay.
+
+    The websocket is opened on first use and re-opened when it drops. Failed
+    connection attempts back off exponentially. Incoming messages are read on
+    a background thread (this also answers pings and notices disconnects), and
+    decoded with `codec` (see nostr.codec.decode_message for `event_type`)
+    and passed to `on_message(relay, message)` if provided.
+    `on_disconnect(relay)` is called when the connection goes away.
+    Connection and send timings are recorded in `metrics` if provided.
+
+    Blocking work for the relay is done on its own worker thread (see run),
+    so that a relay that is slow to connect only holds up itself.
     '''
-    message = json.dumps(['EVENT', event])
+    def __init__(self, url, on_message=None, on_disconnect=None, codec=None, event_type=None, metrics=None):
+        self.url = url
+        self.on_message = on_message
+        self.on_disconnect = on_disconnect
+        self.codec = codec if codec is not None else get_codec()
+        self.event_type = event_type
+        self.metrics = metrics
+        self.ws = None
+        self.lock = threading.Lock()
+        self.connecting = False
+        # incremented by close(), to discard connections that complete after it
+        self.generation = 0
+        self.backoff = 0
+        self.retry_at = 0.0
+        self.executor = None
 
-    for relay_url in relays:
+    def connect(self):
+        '''
+        Return open websocket, connecting if necessary. Raises ConnectionError
+        if a reconnection attempt is not yet due, or if another thread is
+        busy connecting.
+        '''
+        with self.lock:
+            if self.ws is not None and self.ws.connected:
+                return self.ws
+            if self.connecting:
+                raise ConnectionError('connecting')
+            now = time.monotonic()
+            if now < self.retry_at:
+                raise ConnectionError(f'reconnecting in {self.retry_at - now:.0f}s')
+            self.connecting = True
+            generation = self.generation
+
+        # the handshake can take up to CONNECT_TIMEOUT, don't hold the lock
         try:
-            relay = websocket.create_connection(relay_url)
-            relay.send(message)
-            relay.close()
+            ws = websocket.create_connection(self.url, timeout=CONNECT_TIMEOUT)
+        except Exception:
+            with self.lock:
+                self.connecting = False
+                self.backoff = min(max(self.backoff * 2, BACKOFF_MIN), BACKOFF_MAX)
+                self.retry_at = now + self.backoff
+            if self.metrics is not None:
+                self.metrics.count(self.url, 'connect_failures')
+            raise
+        if self.metrics is not None:
+            self.metrics.observe(self.url, 'connect', time.monotonic() - now)
+            self.metrics.count(self.url, 'connects')
+        ws.settimeout(None)
+        with self.lock:
+            self.connecting = False
+            closed = generation != self.generation
+            if not closed:
+                self.ws = ws
+                self.backoff = 0
+        if closed:
+            ws.close()
+            raise ConnectionError('closed')
+        threading.Thread(target=self._reader, args=(ws,), name=f'relay {self.url}', daemon=True).start()
+        return ws
+
+    async def run(self, fn, *args):
+        '''
+        Run blocking `fn(*args)` on the worker thread of this relay. Calls are
+        executed one at a time, in order.
+        '''
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix=f'relay {self.url}')
+        return await asyncio.wrap_future(self.executor.submit(fn, *args))
+
+    def _drop(self, ws):
+        '''
+        Forget about a connection that failed.
+        '''
+        with self.lock:
+            if self.ws is ws:
+                self.ws = None
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    def _reader(self, ws):
+        while ws.connected:
+            try:
+                data = ws.recv()
+            except Exception:
+                break
+            if not data: # control frame
+                continue
+            try:
+                message = decode_message(data, self.codec, self.event_type)
+            except ValueError: # garbage from relay, ignore
+                continue
+            if self.on_message is not None:
+                try:
+                    self.on_message(self, message)
+                except Exception as e: # don't let one bad message end the connection
+                    print(f'{self.url}: error handling message: {e!r}')
+        self._drop(ws)
+        if self.on_disconnect is not None:
+            self.on_disconnect(self)
+
+    def _send(self, ws, message):
+        if self.metrics is None:
+            ws.send(message)
+            return
+        start = time.monotonic()
+        try:
+            ws.send(message)
+        except Exception:
+            self.metrics.count(self.url, 'send_failures')
+            raise
+        self.metrics.observe(self.url, 'send', time.monotonic() - start)
+        self.metrics.count(self.url, 'messages_sent')
+        self.metrics.count(self.url, 'bytes_sent', len(message) if isinstance(message, bytes) else len(message.encode()))
+
+    def send(self, message):
+        '''
+        Send a message. A connection that turns out to be stale is replaced
+        once before giving up.
+        '''
+        for attempt in range(2):
+            ws = self.connect()
+            try:
+                self._send(ws, message)
+                return
+            except Exception:
+                self._drop(ws)
+                if attempt:
+                    raise
+
+    def send_if_connected(self, message):
+        '''
+        Send a message only if the connection is currently open. Errors are
+        ignored.
+        '''
+        ws = self.ws
+        if ws is not None and ws.connected:
+            try:
+                self._send(ws, message)
+            except Exception:
+                pass
+
+    def close(self):
+        with self.lock:
+            ws, self.ws = self.ws, None
+            self.generation += 1
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if ws is not None:
+            ws.close()
+
+class Subscription:
+    '''
+    State of an active REQ subscription. Messages for it are queued as
+    `(type, relay url, payload)` tuples by the relay reader threads.
+    '''
+    def __init__(self, loop, relays, queue_size):
+        self.loop = loop
+        self.queue = asyncio.Queue(queue_size)
+        # relays that have not closed the subscription
+        self.relays = set(relays)
+        self.closed = False
+
+    def deliver(self, item):
+        '''
+        Queue an item from a reader thread. While the queue is full this
+        blocks the thread, pushing back on the relay connection.
+        '''
+        if self.closed:
+            return
+        try:
+            fut = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        except RuntimeError: # loop already closed
+            return
+        while not self.closed:
+            try:
+                fut.result(timeout=1)
+                return
+            except concurrent.futures.TimeoutError:
+                pass
+        fut.cancel()
+
+class RelayPool:
+    '''
+    Pool of persistent relay connections, one per relay. Messages go out to
+    all relays concurrently, so latency is bounded by the slowest relay.
+
+    Wire messages are encoded and decoded with the named JSON `codec`
+    (default: the fastest available, see nostr.codec). Received events are
+    dicts, or instances of `event_type` (such as nostr.event.Event) if given.
+
+    Per-relay timings and counters are collected in `metrics` (a new
+    nostr.metrics.Metrics unless one is passed in).
+    '''
+    def __init__(self, relays, codec=None, event_type=None, metrics=None):
+        self.codec = get_codec(codec)
+        self.event_type = event_type
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.relays = {url: self._new_relay(url) for url in relays}
+        # event id -> {relay url: (send time, future)} for events awaiting OK
+        self.pending = {}
+        # subscription id -> Subscription
+        self.subscriptions = {}
+
+    def _new_relay(self, url):
+        return Relay(url, self._on_message, self._on_disconnect, self.codec, self.event_type, self.metrics)
+
+    def _on_message(self, relay, message):
+        '''
+        Called from relay reader threads.
+        '''
+        # relays can send anything, only look up well-formed ids
+        if not isinstance(message, list) or len(message) < 2 or not isinstance(message[1], str):
+            return
+        if message[0] == 'OK' and len(message) >= 3:
+            waiter = self.pending.get(message[1], {}).get(relay.url)
+            if waiter is None:
+                return
+            sent_at, fut = waiter
+            reason = message[3] if len(message) >= 4 and isinstance(message[3], str) else ''
+            result = PublishResult(bool(message[2]), reason, time.monotonic() - sent_at)
+            self.metrics.observe(relay.url, 'ok', result.rtt)
+            self.metrics.count(relay.url, 'accepted' if result.accepted else 'rejected')
+            try:
+                fut.get_loop().call_soon_threadsafe(_set_result, fut, result)
+            except RuntimeError: # loop already closed
+                pass
+        elif message[0] in ('EVENT', 'EOSE', 'CLOSED'):
+            sub = self.subscriptions.get(message[1])
+            if sub is not None:
+                payload = message[2] if len(message) >= 3 else None
+                sub.deliver((message[0], relay.url, payload))
+
+    def _on_disconnect(self, relay):
+        '''
+        Called from relay reader threads. A dropped connection ends all
+        subscriptions on that relay.
+        '''
+        for sub in list(self.subscriptions.values()):
+            if relay.url in sub.relays:
+                sub.deliver(('CLOSED', relay.url, 'error: disconnected'))
+
+    async def send(self, message):
+        '''
+        Send a raw message to all relays. Returns a dict mapping relay url to
+        exception for the relays that failed.
+        '''
+        relays = list(self.relays.values())
+        results = await asyncio.gather(*(relay.run(relay.send, message) for relay in relays), return_exceptions=True)
+        return {relay.url: e for relay, e in zip(relays, results) if isinstance(e, Exception)}
+
+    def _relays(self, relays):
+        '''
+        Return Relay objects for the given urls (default: all), adding any
+        relays not yet in the pool.
+        '''
+        if relays is None:
+            return list(self.relays.values())
+        for url in relays:
+            if url not in self.relays:
+                self.relays[url] = self._new_relay(url)
+        return [self.relays[url] for url in relays]
+
+    def _send_event(self, relay, message, waiter):
+        '''
+        Send an EVENT message, unless the caller stopped waiting for the
+        reply in the meantime. Blocking, runs on the worker thread of the relay.
+        '''
+        if waiter[1].done():
+            return
+        relay.connect()
+        waiter[0] = time.monotonic()
+        relay.send(message)
+
+    def _forget(self, event_id, url):
+        '''
+        Stop waiting for the OK of event from relay. Cancels the future if it
+        has no result yet, so that a send that is still queued is skipped.
+        '''
+        waiters = self.pending.get(event_id)
+        if waiters is not None:
+            waiter = waiters.pop(url, None)
+            if waiter is not None:
+                waiter[1].cancel()
+            if not waiters:
+                del self.pending[event_id]
+
+    async def _publish_one(self, relay, event_id, message, fut):
+        '''
+        Register `fut` to receive the OK reply of relay, then send the event.
+        Registering happens here on the event loop, so that it is always
+        undone by _forget.
+        '''
+        waiter = [time.monotonic(), fut] # [sent at, future]
+        self.pending.setdefault(event_id, {})[relay.url] = waiter
+        try:
+            await relay.run(self._send_event, relay, message, waiter)
         except Exception as e:
-            print(f'Failed to send to {relay_url}: {e}')
+            _set_result(fut, PublishResult(False, f'error: {e}'))
+
+    async def publish(self, event, timeout=PUBLISH_TIMEOUT, quorum=None, relays=None):
+        '''
+        Send event to all relays and wait for their NIP-01 OK replies.
+
+        Returns a dict mapping relay url to PublishResult. Waits at most
+        `timeout` seconds. If `quorum` is given, returns as soon as that many
+        relays have accepted the event. `relays` restricts publishing to a
+        subset of relays; relays not yet in the pool are added.
+        '''
+        loop = asyncio.get_running_loop()
+        event_id = event['id']
+        message = self.codec.dumps(['EVENT', event])
+        futs = {relay.url: loop.create_future() for relay in self._relays(relays)}
+        senders = [asyncio.create_task(self._publish_one(self.relays[url], event_id, message, fut)) for url, fut in futs.items()]
+        try:
+            deadline = loop.time() + timeout
+            pending = set(futs.values())
+            accepted = 0
+            while pending and (quorum is None or accepted < quorum):
+                done, pending = await asyncio.wait(pending, timeout=deadline - loop.time(), return_when=asyncio.FIRST_COMPLETED)
+                if not done: # deadline passed
+                    for url, fut in futs.items():
+                        if not fut.done():
+                            self.metrics.count(url, 'timeouts')
+                    break
+                accepted += sum(1 for fut in done if fut.result().accepted)
+            return {url: fut.result() if fut.done() else PublishResult(None, 'no reply') for url, fut in futs.items()}
+        finally:
+            for task in senders:
+                task.cancel()
+            for url in futs:
+                self._forget(event_id, url)
+
+    async def publish_many(self, events, window=PUBLISH_WINDOW, timeout=PUBLISH_TIMEOUT, relays=None,
+            max_timeouts=PUBLISH_MAX_TIMEOUTS):
+        '''
+        Publish a sequence of events, pipelined over one connection per relay.
+
+        At most `window` events per relay are awaiting an OK at any time; a
+        slow relay stalls only its own stream. Each event gets `timeout`
+        seconds to be acknowledged after it was sent. After `max_timeouts`
+        consecutive timeouts no more events are sent to a relay, and its
+        remaining events fail with accepted None, so that a dead relay costs
+        about one timeout instead of one per window of events.
+
+        Returns `(results, rates)`: a dict mapping event id to a dict of relay
+        url to PublishResult, and a dict mapping relay url to throughput in
+        acknowledged events per second.
+        '''
+        loop = asyncio.get_running_loop()
+        messages = [(event['id'], self.codec.dumps(['EVENT', event])) for event in events]
+        results = {event_id: {} for event_id, _ in messages}
+
+        async def stream(relay):
+            window_slot = asyncio.Semaphore(window)
+            timeouts = 0 # consecutive
+
+            async def wait_ok(event_id, fut):
+                nonlocal timeouts
+                try:
+                    results[event_id][relay.url] = await asyncio.wait_for(asyncio.shield(fut), timeout)
+                    timeouts = 0
+                except asyncio.TimeoutError:
+                    results[event_id][relay.url] = PublishResult(None, 'no reply')
+                    self.metrics.count(relay.url, 'timeouts')
+                    timeouts += 1
+                finally:
+                    self._forget(event_id, relay.url)
+                    window_slot.release()
+
+            waits = []
+            start = loop.time()
+            for event_id, message in messages:
+                await window_slot.acquire()
+                if timeouts >= max_timeouts:
+                    results[event_id][relay.url] = PublishResult(None, 'not sent: relay not responding')
+                    window_slot.release()
+                    continue
+                fut = loop.create_future()
+                await self._publish_one(relay, event_id, message, fut)
+                waits.append(asyncio.create_task(wait_ok(event_id, fut)))
+            await asyncio.gather(*waits)
+            acked = sum(1 for event_id, _ in messages if results[event_id][relay.url].rtt is not None)
+            return acked / max(loop.time() - start, 1e-9)
+
+        targets = self._relays(relays)
+        rates = await asyncio.gather(*(stream(relay) for relay in targets))
+        return results, {relay.url: rate for relay, rate in zip(targets, rates)}
+
+    async def subscribe(self, filters, relays=None, until_eose=False, sub_id=None,
+            queue_size=SUBSCRIPTION_QUEUE, dedupe_size=DEDUPE_SIZE):
+        '''
+        Subscribe to events matching a list of NIP-01 `filters`.
+
+        Async generator yielding events as they arrive from any relay. Events
+        already seen from another relay are skipped; the `dedupe_size` most
+        recent ids are remembered for this. At most `queue_size` messages are
+        buffered, beyond that the relays are not read until the consumer
+        catches up.
+
+        Ends when all relays have closed the subscription or, if `until_eose`
+        is set, when all relays have sent EOSE. The subscription is CLOSEd on
+        the relays when the generator is closed.
+        '''
+        if sub_id is None:
+            sub_id = os.urandom(8).hex()
+        targets = self._relays(relays)
+        sub = Subscription(asyncio.get_running_loop(), [relay.url for relay in targets], queue_size)
+        self.subscriptions[sub_id] = sub
+        seen = collections.OrderedDict()
+        try:
+            message = self.codec.dumps(['REQ', sub_id] + list(filters))
+            errors = await asyncio.gather(*(relay.run(relay.send, message) for relay in targets), return_exceptions=True)
+            for relay, e in zip(targets, errors):
+                if isinstance(e, Exception):
+                    sub.relays.discard(relay.url)
+            stored = set(sub.relays) # relays that have not sent EOSE
+            while sub.relays and (stored or not until_eose):
+                kind, url, payload = await sub.queue.get()
+                if kind == 'EVENT':
+                    if not isinstance(payload, self.event_type or dict):
+                        continue
+                    event_id = payload.get('id')
+                    if event_id in seen:
+                        seen.move_to_end(event_id)
+                        continue
+                    seen[event_id] = None
+                    if len(seen) > dedupe_size:
+                        seen.popitem(last=False)
+                    yield payload
+                elif kind == 'EOSE':
+                    stored.discard(url)
+                else: # CLOSED
+                    sub.relays.discard(url)
+                    stored.discard(url)
+        finally:
+            sub.closed = True
+            del self.subscriptions[sub_id]
+            message = self.codec.dumps(['CLOSE', sub_id])
+            relays = [self.relays[url] for url in sub.relays]
+            await asyncio.gather(*(relay.run(relay.send_if_connected, message) for relay in relays), return_exceptions=True)
+
+    def close(self):
+        for relay in self.relays.values():
+            relay.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+def send_to_relays(relays, event, timeout=PUBLISH_TIMEOUT, quorum=None, metrics=None, outbox=None):
+    '''
+    Send event to relays and wait for acknowledgements. Returns a dict mapping
+    relay url to PublishResult. Timings are added to `metrics` if given.
+
+    If `outbox` is the path of an outbox database (see nostr.outbox), relays
+    that did not take the event are queued there for a later attempt. While
+    the event is being published, the outbox worker retries earlier
+    deliveries that are due in the background; whatever it doesn't get to is
+    left for the next run.
+    '''
+    async def publish():
+        async with RelayPool(relays, metrics=metrics) as pool:
+            if outbox is None:
+                return await pool.publish(event, timeout, quorum)
+            box = Outbox(outbox, pool)
+            worker = asyncio.create_task(box.run())
+            try:
+                results = await pool.publish(event, timeout, quorum)
+                retry = [url for url, result in results.items() if not is_final(result)]
+                if retry:
+                    box.add(event, retry)
+                    print(f'Queued {len(retry)} relays for retry in {outbox}')
+            finally:
+                worker.cancel()
+                await asyncio.gather(worker, return_exceptions=True)
+                box.close()
+            return results
+
+    results = asyncio.run(publish())
+    for relay_url, result in results.items():
+        # with a quorum, not waiting for the remaining relays is expected
+        if result.accepted is False or (result.accepted is None and quorum is None):
+            print(f'Failed to send to {relay_url}: {result.message}')
+    return results
+
+def publish_many(events, relays, window=PUBLISH_WINDOW, timeout=PUBLISH_TIMEOUT, metrics=None):
+    '''
+    Publish many events to relays over one connection per relay, and report
+    per-relay throughput. Returns a dict mapping event id to a dict of relay
+    url to PublishResult. Timings are added to `metrics` if given.
+    '''
+    async def publish():
+        async with RelayPool(relays, metrics=metrics) as pool:
+            return await pool.publish_many(events, window, timeout)
 
+    results, rates = asyncio.run(publish())
+    for relay_url, rate in rates.items():
+        failed = sum(1 for per_relay in results.values() if not per_relay[relay_url].accepted)
+        print(f'{relay_url}: {rate:.1f} events/s, {failed} of {len(results)} failed')
+    return results
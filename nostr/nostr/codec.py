@@ -0,0 +1,105 @@
+'''
+JSON codecs for relay wire messages.
+
+The fastest available backend is used by default: orjson or msgspec when
+installed, the standard library otherwise. This only concerns the wire
+format; event ids are always computed over the canonical serialization in
+nostr.key, which does not depend on the codec.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import json
+from typing import Callable, NamedTuple
+
+from .event import Event
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+class Codec(NamedTuple):
+    '''
+    `dumps(message)` returns str or UTF-8 bytes, `loads(data)` accepts either
+    and raises ValueError on malformed input.
+    '''
+    name: str
+    dumps: Callable
+    loads: Callable
+
+def _default(obj):
+    if isinstance(obj, Event):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def _json_dumps(message):
+    return json.dumps(message, ensure_ascii=False, separators=(',', ':'), default=_default)
+
+CODECS = {'json': Codec('json', _json_dumps, json.loads)}
+
+# The fast backends do not handle everything the standard library does (such
+# as integers beyond 64 bits); fall back to it for those messages, so that
+# behaviour does not depend on which codec is picked.
+if orjson is not None:
+    def _orjson_dumps(message):
+        try:
+            return orjson.dumps(message, default=_default)
+        except TypeError:
+            return _json_dumps(message)
+
+    def _orjson_loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return json.loads(data)
+
+    CODECS['orjson'] = Codec('orjson', _orjson_dumps, _orjson_loads)
+
+if msgspec is not None:
+    _msgspec_encoder = msgspec.json.Encoder(enc_hook=_default)
+    _msgspec_decoder = msgspec.json.Decoder()
+
+    def _msgspec_dumps(message):
+        try:
+            return _msgspec_encoder.encode(message)
+        except (TypeError, OverflowError):
+            return _json_dumps(message)
+
+    def _msgspec_loads(data):
+        try:
+            return _msgspec_decoder.decode(data)
+        except msgspec.DecodeError:
+            return json.loads(data)
+
+    CODECS['msgspec'] = Codec('msgspec', _msgspec_dumps, _msgspec_loads)
+
+def get_codec(name=None) -> Codec:
+    '''
+    Return codec by name, or the fastest available one if name is None.
+    '''
+    if name is None:
+        for name in ['orjson', 'msgspec', 'json']:
+            if name in CODECS:
+                break
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f'codec {name} is not available, choose from: {", ".join(CODECS)}') from None
+
+def decode_message(data, codec, event_type=None):
+    '''
+    Decode a relay message. If `event_type` is given (such as Event), the
+    event in EVENT messages is converted with `event_type.from_dict`. Raises
+    ValueError for malformed data.
+    '''
+    message = codec.loads(data)
+    if event_type is not None and type(message) is list and len(message) >= 3 and message[0] == 'EVENT':
+        try:
+            message[2] = event_type.from_dict(message[2])
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError(f'malformed event: {e!r}') from None
+    return message
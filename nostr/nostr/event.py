@@ -0,0 +1,119 @@
+'''
+Compact in-memory representation of nostr events.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import json
+import sys
+
+FIELDS = ('id', 'pubkey', 'created_at', 'kind', 'tags', 'content', 'sig')
+HEX_FIELDS = ('id', 'pubkey', 'sig')
+
+def _from_hex(key, value):
+    if value is None:
+        return None
+    rv = bytes.fromhex(value)
+    if rv.hex() != value: # uppercase or whitespace would not survive the round trip
+        raise ValueError(f'{key} is not lowercase hex')
+    return rv
+
+def intern_tags(tags):
+    '''
+    Convert a list of tags to a tuple of tuples, interning the strings so that
+    the tag names and the values that recur over many events (pubkeys, hashtags,
+    relay URLs) are stored once.
+    '''
+    return tuple(tuple(sys.intern(x) if type(x) is str else x for x in tag) if isinstance(tag, list) else tag
+                 for tag in tags)
+
+class Event:
+    '''
+    Nostr event with id, pubkey and sig stored as raw bytes (None if unset)
+    and tags as tuples of interned strings.
+
+    Item access uses the keys and value types of the dict form, so an Event
+    can be passed wherever an event dict is expected, including the
+    functions in nostr.key. Keys outside of NIP-01 are kept in `extra`.
+    '''
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, pubkey, created_at, kind, tags, content, id=None, sig=None, extra=None):
+        self.id = id
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.kind = kind
+        self.tags = tags
+        self.content = content
+        self.sig = sig
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, event):
+        '''
+        Build an Event from an event dict. Raises ValueError if id, pubkey or
+        sig is not lowercase hex.
+        '''
+        extra = {key: value for key, value in event.items() if key not in FIELDS} or None
+        return cls(_from_hex('pubkey', event['pubkey']), event['created_at'], event['kind'],
+                   intern_tags(event['tags']), event['content'],
+                   _from_hex('id', event.get('id')), _from_hex('sig', event.get('sig')), extra)
+
+    def to_dict(self):
+        rv = {}
+        for key in FIELDS:
+            if key in self:
+                rv[key] = self[key]
+        rv['tags'] = [list(tag) if isinstance(tag, tuple) else tag for tag in self.tags]
+        if self.extra:
+            rv.update(self.extra)
+        return rv
+
+    @classmethod
+    def from_json(cls, data):
+        return cls.from_dict(json.loads(data))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), ensure_ascii=False)
+
+    def __getitem__(self, key):
+        if key in HEX_FIELDS:
+            value = getattr(self, key)
+            if value is None:
+                raise KeyError(key)
+            return value.hex()
+        if key in FIELDS:
+            return getattr(self, key)
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in HEX_FIELDS:
+            setattr(self, key, _from_hex(key, value))
+        elif key == 'tags':
+            self.tags = intern_tags(value)
+        elif key in FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        if key in HEX_FIELDS:
+            return getattr(self, key) is not None
+        return key in FIELDS or bool(self.extra and key in self.extra)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        if not isinstance(other, Event):
+            return NotImplemented
+        return all(getattr(self, key) == getattr(other, key) for key in self.__slots__)
+
+    def __repr__(self):
+        return f'Event({self.to_dict()!r})'
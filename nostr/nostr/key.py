@@ -3,34 +3,293 @@ Nostr signing/verifying utilities.
 '''
 # W.J. van der Laan 2024
 # SPDX-License-Identifier: MIT
+import concurrent.futures
 import hashlib
 import json
+import os
+import time
+from typing import NamedTuple, Optional
 
 import secp256k1
 
-def compute_event_hash(event) -> str:
+from .util import LRUCache
+
+# Batches at least this large are verified in a process pool by default.
+PARALLEL_THRESHOLD = 2000
+# Maximum number of events handed to a worker process at once.
+CHUNK_SIZE = 500
+# Number of nonces a proof-of-work worker tries per task.
+POW_CHUNK = 1 << 16
+
+# pubkey hex -> secp256k1.PublicKey
+PUBKEY_CACHE = LRUCache(10000)
+# event id hex -> (sig hex, verification result)
+VERIFIED_CACHE = LRUCache(100000)
+
+def _make_canonical_json():
+    '''
+    Return a function that serializes data like json.dumps in the NIP-01
+    canonical form, but faster.
+    '''
+    # json.dumps builds a new encoder on every call with non-default
+    # arguments, so keep one around instead. Calling the C accelerator directly
+    # also skips the Python-level iterencode wrapper, but it is a CPython
+    # internal: only use it if it works and matches json.dumps on a sample.
+    encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+    c_make_encoder = getattr(json.encoder, 'c_make_encoder', None)
+    if c_make_encoder is not None:
+        try:
+            c_encode = c_make_encoder(None, encoder.default, json.encoder.encode_basestring,
+                    None, ':', ',', False, False, True)
+            def canonical_json(data):
+                return ''.join(c_encode(data, 0))
+            sample = [0, 'é "\\ \n\x00\x7f 🧲', 1731409010, -1, [['t', 'x', 20], []], None]
+            if canonical_json(sample) == json.dumps(sample, separators=(',', ':'), ensure_ascii=False):
+                return canonical_json
+        except Exception:
+            pass
+    return encoder.encode
+
+_canonical_json = _make_canonical_json()
+
+def serialize_event(event) -> bytes:
+    '''
+    Serialize event in the NIP-01 canonical form that is hashed for its id.
+    '''
     data = [0, event['pubkey'], event['created_at'], event['kind'], event['tags'], event['content']]
-    data_str = json.dumps(data, separators=(',', ':'), ensure_ascii=False)
-    return hashlib.sha256(data_str.encode()).hexdigest()
+    return _canonical_json(data).encode()
+
+def event_digest(event) -> bytes:
+    '''
+    Compute raw 32-byte event id.
+    '''
+    return hashlib.sha256(serialize_event(event)).digest()
+
+def compute_event_hash(event) -> str:
+    return event_digest(event).hex()
+
+def parse_pubkey(pubkey: str):
+    '''
+    Return secp256k1.PublicKey for x-only public key hex, cached.
+    '''
+    pk = PUBKEY_CACHE.get(pubkey)
+    if pk is None:
+        pk = secp256k1.PublicKey(b'\x02' + bytes.fromhex(pubkey), True)
+        PUBKEY_CACHE.put(pubkey, pk)
+    return pk
 
 def verify_sig(pubkey: str, hash: str, sig: str) -> bool:
-    pk = secp256k1.PublicKey(b'\x02' + bytes.fromhex(pubkey), True)
-    return pk.schnorr_verify(bytes.fromhex(hash), bytes.fromhex(sig), None, True)
+    return parse_pubkey(pubkey).schnorr_verify(bytes.fromhex(hash), bytes.fromhex(sig), None, True)
 
 def verify_event(event) -> bool:
+    '''
+    Verify event id and signature. The outcome is remembered by id, so seeing
+    the same event again only costs hashing it.
+    '''
     if compute_event_hash(event) != event['id']:
         return False
-    return verify_sig(event['pubkey'], event['id'], event['sig'])
+    cached = VERIFIED_CACHE.get(event['id'])
+    if cached is not None and cached[0] == event['sig']:
+        return cached[1]
+    rv = verify_sig(event['pubkey'], event['id'], event['sig'])
+    VERIFIED_CACHE.put(event['id'], (event['sig'], rv))
+    return rv
+
+def _verify_chunk(events):
+    '''
+    Verify a list of events. Malformed events count as invalid.
+    '''
+    rv = []
+    for event in events:
+        try:
+            rv.append(verify_event(event))
+        except Exception: # missing fields, bad hex, invalid public key
+            rv.append(False)
+    return rv
+
+def verify_events(events, processes=None) -> list:
+    '''
+    Verify many events. Returns a list of booleans in input order.
+
+    With `processes` unset, batches of at least PARALLEL_THRESHOLD events are
+    spread over a process pool with one worker per core. Pass `processes=1`
+    to always verify in-process, or a larger number to force a pool of that
+    size.
+    '''
+    events = list(events)
+    if processes is None:
+        processes = os.cpu_count() if len(events) >= PARALLEL_THRESHOLD else 1
+    if processes <= 1 or len(events) <= 1:
+        return _verify_chunk(events)
+    size = max(min(CHUNK_SIZE, -(-len(events) // processes)), 1)
+    chunks = [events[i:i + size] for i in range(0, len(events), size)]
+    with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+        return [ok for result in executor.map(_verify_chunk, chunks) for ok in result]
+
+def leading_zero_bits(digest: bytes) -> int:
+    '''
+    NIP-13 difficulty of an event id.
+    '''
+    return len(digest) * 8 - int.from_bytes(digest, 'big').bit_length()
+
+class PowResult(NamedTuple):
+    '''
+    Outcome of proof-of-work mining. `difficulty` is the number of leading
+    zero bits actually reached, which is below the target if mining was cut
+    off by the deadline.
+    '''
+    nonce: int
+    difficulty: int
+    hashes: int
+    elapsed: float
+
+    @property
+    def hashrate(self):
+        return self.hashes / self.elapsed if self.elapsed else 0.0
+
+def _pow_search(prefix, suffix, start, stop, target, deadline):
+    '''
+    Try nonces in range(start, stop) until one reaches `target` bits or the
+    deadline passes. Returns (best nonce, its difficulty, hashes computed).
+    '''
+    base = hashlib.sha256(prefix)
+    best_nonce, best_bits = start, -1
+    nonce = start
+    while nonce < stop:
+        batch_end = min(nonce + 4096, stop)
+        for n in range(nonce, batch_end):
+            h = base.copy()
+            h.update(b'%d' % n + suffix)
+            bits = leading_zero_bits(h.digest())
+            if bits > best_bits:
+                best_nonce, best_bits = n, bits
+                if bits >= target:
+                    return best_nonce, best_bits, n - start + 1
+        nonce = batch_end
+        if deadline is not None and time.time() >= deadline:
+            break
+    return best_nonce, best_bits, nonce - start
+
+def mine_event(event, difficulty, timeout=None, processes=None) -> PowResult:
+    '''
+    Add a NIP-13 nonce tag to event that makes its id have at least
+    `difficulty` leading zero bits. Any existing nonce tag is replaced.
+
+    The serialized event up to the nonce is hashed once; each attempt only
+    hashes the nonce and the rest of the event. Nonce ranges are spread over
+    `processes` worker processes (default: one per core). If `timeout`
+    seconds pass first, the best nonce found so far is used.
+    '''
+    # serialize with a placeholder nonce to find the fixed parts around it
+    marker = os.urandom(16).hex()
+    tags = [tag for tag in event['tags'] if not tag or tag[0] != 'nonce']
+    event['tags'] = tags + [['nonce', marker, str(difficulty)]]
+    prefix, suffix = serialize_event(event).split(marker.encode())
+
+    if processes is None:
+        processes = os.cpu_count()
+    start_time = time.time()
+    deadline = start_time + timeout if timeout is not None else None
+    best_nonce, best_bits, hashes = 0, -1, 0
+
+    if processes <= 1:
+        best_nonce, best_bits, hashes = _pow_search(prefix, suffix, 0, 1 << 64, difficulty, deadline)
+    else:
+        executor = concurrent.futures.ProcessPoolExecutor(processes)
+        next_chunk = 0
+        def submit():
+            nonlocal next_chunk
+            start = next_chunk * POW_CHUNK
+            next_chunk += 1
+            return executor.submit(_pow_search, prefix, suffix, start, start + POW_CHUNK, difficulty, deadline)
+        try:
+            running = {submit() for _ in range(processes * 2)}
+            while running:
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for fut in done:
+                    nonce, bits, count = fut.result()
+                    hashes += count
+                    if bits > best_bits:
+                        best_nonce, best_bits = nonce, bits
+                if best_bits >= difficulty or (deadline is not None and time.time() >= deadline):
+                    break
+                running.update(submit() for _ in done)
+        finally:
+            executor.shutdown(cancel_futures=True)
+
+    # assign the tags again rather than patching the nonce in place, as the
+    # event may have converted them on assignment (see nostr.event.Event)
+    event['tags'] = tags + [['nonce', str(best_nonce), str(difficulty)]]
+    return PowResult(best_nonce, best_bits, hashes, time.time() - start_time)
+
+# NostrKey of a signing worker process
+_worker_key = None
+
+def _sign_init(private_key):
+    global _worker_key
+    _worker_key = NostrKey(private_key)
+
+def _sign_chunk(events, key=None):
+    '''
+    Sign a list of events, in a worker thread or process. Returns (id, sig)
+    pairs so that results can be copied back from worker processes.
+    '''
+    if key is None:
+        key = _worker_key
+    for event in events:
+        key.sign_event(event)
+    return [(event['id'], event['sig']) for event in events]
 
 class NostrKey:
     def __init__(self, private_key):
         self.sk = secp256k1.PrivateKey(bytes.fromhex(private_key))
         self.public_key = self.sk.pubkey.serialize()[1:].hex()
 
-    def sign_event(self, event):
+    def sign_event(self, event, difficulty=None, timeout=None, processes=None) -> Optional[PowResult]:
+        '''
+        Set id and sig of event (a dict or Event). If `difficulty` is given,
+        first mine a NIP-13 proof of work and return the PowResult.
+        '''
         if event['pubkey'] != self.public_key:
             raise ValueError('Unknown pubkey')
-        event['id'] = compute_event_hash(event)
+        pow_result = None
+        if difficulty is not None:
+            pow_result = mine_event(event, difficulty, timeout, processes)
+        digest = event_digest(event)
+        event['id'] = digest.hex()
 
-        sig = self.sk.schnorr_sign(bytes.fromhex(event['id']), None, raw=True)
+        sig = self.sk.schnorr_sign(digest, None, raw=True)
         event['sig'] = sig.hex()
+        return pow_result
+
+    def sign_events(self, events, workers=None, processes=False):
+        '''
+        Sign many events in place, like sign_event. Returns the events in input
+        order.
+
+        The work is spread over `workers` threads (default: one per core);
+        secp256k1 and hashlib release the GIL, the JSON serialization does
+        not. Set `processes` to use worker processes instead, which scales
+        further at the cost of copying the events.
+        '''
+        events = list(events)
+        for event in events:
+            if event['pubkey'] != self.public_key:
+                raise ValueError('Unknown pubkey')
+        if workers is None:
+            workers = os.cpu_count()
+        if workers <= 1 or len(events) <= 1:
+            _sign_chunk(events, self)
+            return events
+        size = max(min(CHUNK_SIZE, -(-len(events) // workers)), 1)
+        chunks = [events[i:i + size] for i in range(0, len(events), size)]
+        if processes:
+            with concurrent.futures.ProcessPoolExecutor(workers, initializer=_sign_init, initargs=(self.sk.private_key.hex(),)) as executor:
+                for chunk, results in zip(chunks, executor.map(_sign_chunk, chunks)):
+                    for event, (event_id, sig) in zip(chunk, results):
+                        event['id'] = event_id
+                        event['sig'] = sig
+        else:
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                list(executor.map(_sign_chunk, chunks, [self] * len(chunks)))
+        return events
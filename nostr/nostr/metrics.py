@@ -0,0 +1,153 @@
+'''
+Relay client instrumentation.
+
+A RelayPool records, per relay, histograms of the time to connect, to send a
+message and to receive the OK for a published event, counters for
+successes and failures, and the number of bytes sent. Observations are also
+passed to optional hook callbacks, for forwarding to a monitoring system.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets in seconds: 1ms doubling up to ~65s.
+# Anything slower goes in a final overflow bucket.
+BUCKETS = tuple(0.001 * 2 ** i for i in range(17))
+
+# Timings, recorded in a Histogram per relay.
+TIMINGS = ('connect', 'send', 'ok')
+# Counters per relay.
+COUNTERS = ('connects', 'connect_failures', 'messages_sent', 'send_failures', 'bytes_sent',
+            'accepted', 'rejected', 'timeouts')
+
+class Histogram:
+    '''
+    Histogram of durations with exponentially sized buckets.
+    '''
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def quantile(self, q):
+        '''
+        Estimate the q-quantile (0 <= q <= 1), as the upper bound of the
+        bucket it falls in, limited by the observed extremes. Returns None if
+        there are no observations.
+        '''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                bound = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+class RelayMetrics:
+    '''
+    Timings and counters for one relay.
+    '''
+    def __init__(self):
+        for name in TIMINGS:
+            setattr(self, name, Histogram())
+        for name in COUNTERS:
+            setattr(self, name, 0)
+
+    def summary(self):
+        '''
+        Return the counters, and the count, mean and 50/90/99th percentiles
+        of the timings, as a flat dict.
+        '''
+        rv = {name: getattr(self, name) for name in COUNTERS}
+        for name in TIMINGS:
+            hist = getattr(self, name)
+            rv[f'{name}_count'] = hist.count
+            rv[f'{name}_mean'] = hist.mean
+            for q in (50, 90, 99):
+                rv[f'{name}_p{q}'] = hist.quantile(q / 100)
+        return rv
+
+class Metrics:
+    '''
+    Metrics of a set of relays. `relays` maps relay url to RelayMetrics.
+
+    Each hook is called as `hook(url, name, value)` for every observation:
+    the duration in seconds for the timings in TIMINGS, and the increment for
+    the counters in COUNTERS. Hooks are called from relay and worker threads
+    and should return quickly.
+    '''
+    def __init__(self, hooks=()):
+        self.relays = {}
+        self.hooks = list(hooks)
+        self.lock = threading.Lock()
+
+    def _relay(self, url):
+        rv = self.relays.get(url)
+        if rv is None:
+            rv = self.relays.setdefault(url, RelayMetrics())
+        return rv
+
+    def _call_hooks(self, url, name, value):
+        for hook in self.hooks:
+            try:
+                hook(url, name, value)
+            except Exception as e:
+                print(f'Metrics hook {hook!r} failed: {e!r}')
+
+    def observe(self, url, name, seconds):
+        '''
+        Record a timing for relay.
+        '''
+        with self.lock:
+            getattr(self._relay(url), name).observe(seconds)
+        self._call_hooks(url, name, seconds)
+
+    def count(self, url, name, n=1):
+        '''
+        Increase a counter for relay.
+        '''
+        with self.lock:
+            relay = self._relay(url)
+            setattr(relay, name, getattr(relay, name) + n)
+        self._call_hooks(url, name, n)
+
+    def summary(self):
+        '''
+        Return a dict mapping relay url to RelayMetrics.summary().
+        '''
+        with self.lock:
+            return {url: relay.summary() for url, relay in self.relays.items()}
+
+    def report(self):
+        '''
+        Format a table of the main figures per relay, slowest OK latency first.
+        '''
+        def ms(value):
+            return f'{value * 1000:8.1f}' if value is not None else f'{"-":>8}'
+
+        summary = self.summary()
+        lines = [f'{"relay":40} {"ok":>5} {"fail":>5} {"conn ms":>8} {"ok p50":>8} {"ok p90":>8} {"ok p99":>8} {"sent kB":>8}']
+        for url, s in sorted(summary.items(), key=lambda item: -(item[1]['ok_p90'] or 0)):
+            failed = s['rejected'] + s['timeouts'] + s['connect_failures'] + s['send_failures']
+            lines.append(f'{url:40} {s["accepted"]:5} {failed:5} {ms(s["connect_mean"])} '
+                         f'{ms(s["ok_p50"])} {ms(s["ok_p90"])} {ms(s["ok_p99"])} {s["bytes_sent"] / 1000:8.1f}')
+        return '\n'.join(lines)
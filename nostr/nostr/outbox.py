@@ -0,0 +1,138 @@
+'''
+Durable outbox for relay publishing.
+
+Signed events are stored in a SQLite database together with the set of relays
+they still have to be delivered to. A background worker publishes them
+through a RelayPool and retries failed relays with exponential backoff.
+Pending deliveries are only removed after the relay acknowledged the event,
+so it is safe to kill and restart the process at any point; at worst an
+event is sent to a relay twice, which relays ignore.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import asyncio
+import json
+import sqlite3
+import time
+
+# Minimum and maximum delay between delivery attempts, in seconds.
+RETRY_MIN = 5
+RETRY_MAX = 3600
+# Relay rejections with these prefixes are transient and will be retried.
+# Other rejections (invalid:, blocked:, pow:, ...) are final.
+RETRY_PREFIXES = ('rate-limited:', 'error:')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    event TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    event_id TEXT NOT NULL REFERENCES events(id),
+    relay TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    PRIMARY KEY (event_id, relay)
+);
+CREATE INDEX IF NOT EXISTS pending_next_try ON pending(next_try);
+'''
+
+def retry_delay(attempts):
+    '''
+    Delay before the next attempt after `attempts` failed attempts.
+    '''
+    return min(RETRY_MIN * 2 ** (attempts - 1), RETRY_MAX)
+
+def is_final(result):
+    '''
+    Return whether a PublishResult ends delivery to that relay: the event was
+    accepted, or rejected for a reason that retrying won't fix.
+    '''
+    return bool(result.accepted) or (result.accepted is False and not result.message.startswith(RETRY_PREFIXES))
+
+class Outbox:
+    '''
+    Disk-backed queue of signed events waiting to be delivered to relays.
+    '''
+    def __init__(self, path, pool):
+        self.pool = pool
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        self.wakeup = asyncio.Event()
+
+    def add(self, event, relays=None):
+        '''
+        Queue signed event for delivery to relays (by default, all relays in
+        the pool). Returns as soon as the event is on disk.
+        '''
+        if relays is None:
+            relays = list(self.pool.relays)
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO events (id, event) VALUES (?, ?)', (event['id'], json.dumps(event)))
+            self.db.executemany('INSERT OR IGNORE INTO pending (event_id, relay) VALUES (?, ?)', [(event['id'], relay) for relay in relays])
+        self.wakeup.set()
+
+    def pending(self):
+        '''
+        Return a dict mapping event id to the list of relays it still has to
+        be delivered to.
+        '''
+        rv = {}
+        for event_id, relay in self.db.execute('SELECT event_id, relay FROM pending ORDER BY rowid'):
+            rv.setdefault(event_id, []).append(relay)
+        return rv
+
+    async def flush(self, now=None):
+        '''
+        Make one delivery attempt for every event that is due. The events for
+        each relay are pipelined, and relays are published to concurrently.
+        Returns the time at which the next attempt is due, or None if the
+        outbox is empty.
+        '''
+        if now is None:
+            now = time.time()
+        due = {}
+        for relay, event_id, data, attempts in self.db.execute(
+                'SELECT relay, event_id, event, attempts FROM pending JOIN events ON events.id = event_id '
+                'WHERE next_try <= ? ORDER BY pending.rowid', (now,)):
+            due.setdefault(relay, []).append((event_id, json.loads(data), attempts))
+
+        async def publish(relay, entries):
+            results, _ = await self.pool.publish_many([event for _, event, _ in entries], relays=[relay])
+            return results
+        all_results = await asyncio.gather(*(publish(relay, entries) for relay, entries in due.items()))
+
+        with self.db:
+            for (relay, entries), results in zip(due.items(), all_results):
+                for event_id, _, attempts in entries:
+                    result = results[event_id][relay]
+                    if is_final(result):
+                        if not result.accepted:
+                            print(f'Relay {relay} rejected {event_id}: {result.message}')
+                        self.db.execute('DELETE FROM pending WHERE event_id = ? AND relay = ?', (event_id, relay))
+                    else:
+                        attempts += 1
+                        self.db.execute('UPDATE pending SET attempts = ?, next_try = ?, last_error = ? WHERE event_id = ? AND relay = ?',
+                                (attempts, now + retry_delay(attempts), result.message, event_id, relay))
+            self.db.execute('DELETE FROM events WHERE NOT EXISTS (SELECT 1 FROM pending WHERE event_id = events.id)')
+
+        (next_try,) = self.db.execute('SELECT MIN(next_try) FROM pending').fetchone()
+        return next_try
+
+    async def run(self):
+        '''
+        Deliver queued events until cancelled.
+        '''
+        while True:
+            self.wakeup.clear()
+            next_try = await self.flush()
+            timeout = None if next_try is None else max(next_try - time.time(), 0)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        self.db.close()
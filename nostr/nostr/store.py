@@ -0,0 +1,163 @@
+'''
+Local SQLite store for signed nostr events.
+
+Events are kept in full, with indexed columns for the fields that NIP-01
+filters select on. Values of single-letter tags go into a separate indexed
+table for `#<letter>` filters.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import json
+import sqlite3
+
+from .event import Event
+
+# Number of added events buffered before they are written in one transaction.
+BATCH_SIZE = 1000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    pubkey TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    kind INTEGER NOT NULL,
+    event TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_pubkey ON events(pubkey, created_at);
+CREATE INDEX IF NOT EXISTS events_kind ON events(kind, created_at);
+CREATE INDEX IF NOT EXISTS events_created_at ON events(created_at);
+CREATE TABLE IF NOT EXISTS tags (
+    event_id TEXT NOT NULL REFERENCES events(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tags_name_value ON tags(name, value);
+CREATE INDEX IF NOT EXISTS tags_event_id ON tags(event_id);
+'''
+
+def indexed_tags(event):
+    '''
+    Return (name, value) pairs of the single-letter tags of event, which are
+    the ones that can be queried.
+    '''
+    return {(tag[0], tag[1]) for tag in event['tags']
+            if len(tag) >= 2 and len(tag[0]) == 1 and tag[0].isascii() and tag[0].isalpha()}
+
+def filter_to_sql(filt):
+    '''
+    Translate a NIP-01 filter to an SQL query on the events table and its
+    parameters. Raises ValueError for unsupported filter keys.
+    '''
+    where = []
+    params = []
+    def values_in(column, values):
+        where.append(f'{column} IN ({",".join("?" * len(values))})')
+        params.extend(values)
+
+    for key, value in filt.items():
+        if key == 'ids':
+            values_in('id', value)
+        elif key == 'authors':
+            values_in('pubkey', value)
+        elif key == 'kinds':
+            values_in('kind', value)
+        elif key == 'since':
+            where.append('created_at >= ?')
+            params.append(value)
+        elif key == 'until':
+            where.append('created_at <= ?')
+            params.append(value)
+        elif key.startswith('#') and len(key) == 2:
+            where.append(f'id IN (SELECT event_id FROM tags WHERE name = ? AND value IN ({",".join("?" * len(value))}))')
+            params.append(key[1])
+            params.extend(value)
+        elif key != 'limit':
+            raise ValueError(f'unsupported filter key {key}')
+
+    sql = 'SELECT event FROM events'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY created_at DESC, id'
+    if 'limit' in filt:
+        sql += ' LIMIT ?'
+        params.append(filt['limit'])
+    return sql, params
+
+class EventStore:
+    '''
+    SQLite-backed event store, using write-ahead logging. Added events are
+    buffered and written in batches; queries flush the buffer first.
+    '''
+    def __init__(self, path, batch_size=BATCH_SIZE):
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+        self.batch_size = batch_size
+        self.batch = {}
+
+    def add(self, event):
+        '''
+        Queue signed event (a dict or an Event) for storage. Events already in
+        the store are ignored.
+        '''
+        self.batch[event['id']] = event
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, events):
+        for event in events:
+            self.add(event)
+        self.flush()
+
+    def flush(self):
+        '''
+        Write buffered events in one transaction. Returns the number of
+        events that were new.
+        '''
+        added = 0
+        with self.db:
+            for event in self.batch.values():
+                data = event.to_json() if isinstance(event, Event) else json.dumps(event, ensure_ascii=False)
+                cur = self.db.execute('INSERT OR IGNORE INTO events (id, pubkey, created_at, kind, event) VALUES (?, ?, ?, ?, ?)',
+                        (event['id'], event['pubkey'], event['created_at'], event['kind'], data))
+                if cur.rowcount:
+                    added += 1
+                    self.db.executemany('INSERT INTO tags (event_id, name, value) VALUES (?, ?, ?)',
+                            [(event['id'], name, value) for name, value in indexed_tags(event)])
+        self.batch.clear()
+        return added
+
+    def __contains__(self, event_id):
+        if event_id in self.batch:
+            return True
+        return self.db.execute('SELECT 1 FROM events WHERE id = ?', (event_id,)).fetchone() is not None
+
+    def get(self, event_id):
+        '''
+        Return event by id, or None if it is not in the store.
+        '''
+        if event_id in self.batch:
+            return self.batch[event_id]
+        row = self.db.execute('SELECT event FROM events WHERE id = ?', (event_id,)).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def query(self, filters):
+        '''
+        Return events matching any of a list of NIP-01 filters, newest first.
+        '''
+        self.flush()
+        if isinstance(filters, dict):
+            filters = [filters]
+        events = {}
+        for filt in filters:
+            sql, params = filter_to_sql(filt)
+            for (data,) in self.db.execute(sql, params):
+                event = json.loads(data)
+                events.setdefault(event['id'], event)
+        return sorted(events.values(), key=lambda event: (-event['created_at'], event['id']))
+
+    def close(self):
+        self.flush()
+        self.db.close()
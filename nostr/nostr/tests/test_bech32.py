@@ -0,0 +1,83 @@
+import random
+
+import pytest
+
+from nostr import bech32
+from nostr.bech32 import *
+
+def reference_checksum(hrp, data, spec):
+    const = BECH32M_CONST if spec == Encoding.BECH32M else 1
+    polymod = bech32_polymod(bech32_hrp_expand(hrp) + data + [0, 0, 0, 0, 0, 0]) ^ const
+    return [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+
+def reference_verify(hrp, data):
+    const = bech32_polymod(bech32_hrp_expand(hrp) + data)
+    return {1: Encoding.BECH32, BECH32M_CONST: Encoding.BECH32M}.get(const)
+
+def test_checksum():
+    rng = random.Random(0)
+    for _ in range(200):
+        hrp = rng.choice(['npub', 'note', 'nprofile', 'bc', 'a', 'x' * 20])
+        data = [rng.randrange(32) for _ in range(rng.randrange(100))]
+        for spec in Encoding:
+            checksum = bech32_create_checksum(hrp, data, spec)
+            assert checksum == reference_checksum(hrp, data, spec)
+            assert bech32_verify_checksum(hrp, data + checksum) == reference_verify(hrp, data + checksum) == spec
+        corrupted = data + [0, 0, 0, 0, 0, 0]
+        assert bech32_verify_checksum(hrp, corrupted) == reference_verify(hrp, corrupted)
+
+@pytest.mark.parametrize('use_numpy', [True, False])
+def test_bulk(monkeypatch, use_numpy):
+    if not use_numpy:
+        monkeypatch.setattr(bech32, 'numpy', None)
+    elif bech32.numpy is None:
+        pytest.skip('numpy not available')
+    rng = random.Random(1)
+    datas = [convertbits(rng.randbytes(32), 8, 5) for _ in range(100)] + [[1, 2, 3], []]
+    strings = bech32_encode_many('npub', datas, Encoding.BECH32)
+    assert strings == [bech32_encode('npub', data, Encoding.BECH32) for data in datas]
+
+    strings += [
+        strings[0][:-1] + ('q' if strings[0][-1] != 'q' else 'p'), # bad checksum
+        strings[1].upper(),
+        strings[2][:10] + strings[2][10:].upper(), # mixed case
+        'npub1' + 'b' * 58, # invalid character
+        'note10gvceh72dtwe9g2zscfmr6v75va9hd55uv8207g3g3ywknjaqrqs8rtr5w',
+        '',
+        '1qqqqqq',
+    ]
+    assert bech32_decode_many(strings) == [bech32_decode(s) for s in strings]
+    assert bech32_decode_many(strings, 60) == [bech32_decode(s, 60) for s in strings]
+
+def test_bulk_small(monkeypatch):
+    # below VECTORIZE_MIN strings per group, NumPy is not touched
+    monkeypatch.setattr(bech32, 'numpy', object())
+    rng = random.Random(3)
+    datas = [convertbits(rng.randbytes(32), 8, 5) for _ in range(bech32.VECTORIZE_MIN - 1)]
+    strings = bech32_encode_many('npub', datas, Encoding.BECH32)
+    assert strings == [bech32_encode('npub', data, Encoding.BECH32) for data in datas]
+    assert bech32_decode_many(strings) == [bech32_decode(s) for s in strings]
+    mixed = [convertbits(rng.randbytes(n), 8, 5) for n in range(bech32.VECTORIZE_MIN)]
+    assert bech32_encode_many('npub', mixed, Encoding.BECH32) == [bech32_encode('npub', data, Encoding.BECH32) for data in mixed]
+    assert bech32_decode_many(strings[:1]) == [bech32_decode(strings[0])]
+    assert bech32_decode_many([]) == [] and bech32_encode_many('npub', [], Encoding.BECH32) == []
+
+def test_convertbits_bytes():
+    rng = random.Random(2)
+    for n in range(64):
+        data = rng.randbytes(n)
+        for buf in [data, bytearray(data), memoryview(data)]:
+            assert convertbits_bytes(buf, 8, 5) == bytes(convertbits(data, 8, 5))
+        values = bytes(rng.randrange(32) for _ in range(n))
+        if n and rng.random() < 0.3: # non-zero padding bits or out of range value
+            values = values[:-1] + bytes([rng.randrange(256)])
+        expected = convertbits(values, 5, 8, False)
+        assert convertbits_bytes(values, 5, 8, False) == (bytes(expected) if expected is not None else None)
+        for frombits, tobits, pad in [(8, 5, False), (5, 8, True), (8, 1, True), (1, 8, False)]:
+            values = bytes(b & ((1 << frombits) - 1) for b in data)
+            expected = convertbits(values, frombits, tobits, pad)
+            assert convertbits_bytes(values, frombits, tobits, pad) == (bytes(expected) if expected is not None else None)
+    assert convertbits_bytes(b'\x01\x02', 5, 8, False) is None # too many leftover bits
+
+    key = bytes.fromhex('0aa39e5aef99a000a7bdb0b499158c92bc4aa20fb65931a52d055b5eb6dff738')
+    assert bech32_encode('npub', convertbits_bytes(key, 8, 5), Encoding.BECH32) == bech32_encode('npub', convertbits(key, 8, 5), Encoding.BECH32)
@@ -0,0 +1,80 @@
+import mmap
+import random
+
+import pytest
+
+import bencode
+
+def plain(value):
+    if isinstance(value, bencode.LazyDict):
+        return {key: plain(value[key]) for key in value}
+    if isinstance(value, list):
+        return [plain(item) for item in value]
+    if isinstance(value, memoryview):
+        return bytes(value)
+    return value
+
+def decode_result(decode, data):
+    try:
+        return plain(decode(data))
+    except bencode.BTFailure as e:
+        return ('BTFailure', str(e))
+
+TORRENT = bencode.bencode({
+    b'announce': b'udp://tracker.example.com:1337',
+    b'comment': b'Bitcoin Core 28.0',
+    b'info': {
+        b'name': b'bitcoin-28.0',
+        b'piece length': 262144,
+        b'pieces': bytes(range(256)) * 4,
+        b'files': [{b'length': 48000000 + i, b'path': [b'bitcoin-28.0', f'file{i}'.encode()]} for i in range(5)],
+    },
+    b'negative': -42,
+    b'empty': [[], {}, b''],
+})
+
+def test_bdecode_lazy():
+    torrent = bencode.bdecode_lazy(TORRENT)
+    info = torrent[b'info']
+    assert isinstance(info, bencode.LazyDict)
+    assert isinstance(info[b'pieces'], memoryview)
+    assert info[b'pieces'].obj is TORRENT # a view, not a copy
+    assert bytes(info[b'files'][3][b'path'][1]) == b'file3'
+    assert plain(torrent) == bencode.bdecode(TORRENT)
+    assert plain(bencode.bdecode_lazy(memoryview(TORRENT)[0:])) == bencode.bdecode(TORRENT)
+
+def test_bdecode_file(tmp_path):
+    path = tmp_path / 'test.torrent'
+    path.write_bytes(TORRENT)
+    torrent = bencode.bdecode_file(path)
+    assert isinstance(torrent[b'info'][b'name'].obj, mmap.mmap)
+    assert plain(torrent) == bencode.bdecode(TORRENT)
+
+    path.write_bytes(b'')
+    with pytest.raises(bencode.BTFailure):
+        bencode.bdecode_file(path)
+
+@pytest.mark.parametrize('data', [
+    b'', b'e', b'i', b'ie', b'i-0e', b'i03e', b'i-e', b'i0e', b'i-3e', b'i 3e', b'i1_0e', b'i3', b'i3ee',
+    b'0:', b'00:', b'3:ab', b'3:abcd', b'1 :a', b'l', b'le', b'lee', b'l3:abe', b'd', b'de', b'd1:ae',
+    b'di1ei2ee', b'd1:ai1e1:ai2ee', b'd1:bi1e1:ai2ee', b'x', b'l' * 10 + b'e' * 10, b'4:\xff\x00ab',
+])
+def test_bdecode_lazy_rejects_like_bdecode(data):
+    assert decode_result(bencode.bdecode_lazy, data) == decode_result(bencode.bdecode, data)
+
+def test_bdecode_lazy_fuzz():
+    rng = random.Random(0)
+    alphabet = b'0123456789:ildex-_ '
+    for _ in range(3000):
+        data = bytearray(TORRENT[rng.randrange(len(TORRENT)):][:rng.randrange(1, 200)] if rng.random() < 0.3 else TORRENT)
+        for _ in range(rng.randrange(1, 4)):
+            op = rng.randrange(3)
+            i = rng.randrange(len(data) + 1)
+            if op == 0 and i < len(data):
+                data[i] = rng.choice(alphabet)
+            elif op == 1:
+                data.insert(i, rng.choice(alphabet))
+            elif i < len(data):
+                del data[i]
+        data = bytes(data)
+        assert decode_result(bencode.bdecode_lazy, data) == decode_result(bencode.bdecode, data)
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import queue
+import time
+
+import pytest
+import websocket
+
+from nostr.client import RelayPool
+
+class FakeRelay:
+    '''
+    In-process relay. `mode` is one of:
+    'accept' / 'reject': answer EVENT with OK true / false,
+    'silent': never answer EVENT,
+    'hold': keep the OKs until release() is called,
+    'down': refuse connections.
+    Connecting takes `handshake` seconds. REQ is answered with `events`,
+    then EOSE, or with CLOSED if `close_subs` is set.
+    '''
+    def __init__(self, mode='accept', handshake=0, events=(), close_subs=False):
+        self.mode = mode
+        self.handshake = handshake
+        self.events = list(events)
+        self.close_subs = close_subs
+        self.connects = 0
+        self.received = []
+        self.held = []
+        self.conn = None
+
+    def handle(self, message):
+        self.received.append(message)
+        if message[0] == 'EVENT':
+            ok = ['OK', message[1]['id'], self.mode != 'reject', 'blocked: test' if self.mode == 'reject' else '']
+            if self.mode == 'hold':
+                self.held.append(ok)
+            elif self.mode != 'silent':
+                return [ok]
+        elif message[0] == 'REQ':
+            if self.close_subs:
+                return [['CLOSED', message[1], 'auth-required: test']]
+            return [['EVENT', message[1], event] for event in self.events] + [['EOSE', message[1]]]
+        return []
+
+    def release(self):
+        self.mode = 'accept'
+        for ok in self.held:
+            self.conn.replies.put(json.dumps(ok))
+        self.held = []
+
+    def sent(self, kind):
+        return [message for message in self.received if message[0] == kind]
+
+class FakeConnection:
+    def __init__(self, relay):
+        self.relay = relay
+        self.connected = True
+        self.replies = queue.Queue()
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, data):
+        if not self.connected:
+            raise websocket.WebSocketConnectionClosedException('closed')
+        for reply in self.relay.handle(json.loads(data)):
+            self.replies.put(json.dumps(reply))
+
+    def recv(self):
+        data = self.replies.get()
+        if data is None:
+            raise websocket.WebSocketConnectionClosedException('closed')
+        return data
+
+    def close(self):
+        if self.connected:
+            self.connected = False
+            self.replies.put(None)
+
+@pytest.fixture
+def relays(monkeypatch):
+    '''
+    Dict of url to FakeRelay, served by websocket.create_connection.
+    '''
+    relays = {}
+    def create_connection(url, timeout=None):
+        relay = relays[url]
+        relay.connects += 1
+        time.sleep(relay.handshake)
+        if relay.mode == 'down':
+            raise ConnectionRefusedError('connection refused')
+        relay.conn = FakeConnection(relay)
+        return relay.conn
+    monkeypatch.setattr(websocket, 'create_connection', create_connection)
+    return relays
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_publish(relays):
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://r': FakeRelay('reject'),
+                   'wss://s': FakeRelay('silent'), 'wss://d': FakeRelay('down')})
+    async def publish():
+        async with RelayPool(relays) as pool:
+            start = time.monotonic()
+            results = await pool.publish({'id': 'aa'}, timeout=0.2)
+            return results, time.monotonic() - start, pool
+
+    results, elapsed, pool = run(publish())
+    assert results['wss://a'].accepted is True and results['wss://a'].rtt is not None
+    assert results['wss://r'] == (False, 'blocked: test', results['wss://r'].rtt)
+    assert results['wss://s'] == (None, 'no reply', None)
+    assert results['wss://d'].accepted is False and results['wss://d'].message == 'error: connection refused'
+    assert 0.2 <= elapsed < 1
+    assert relays['wss://s'].sent('EVENT') == [['EVENT', {'id': 'aa'}]]
+    assert pool.pending == {}
+    summary = pool.metrics.summary()
+    assert summary['wss://s']['timeouts'] == 1 and summary['wss://a']['accepted'] == 1
+    assert summary['wss://d']['connect_failures'] == 1
+
+def test_publish_quorum(relays):
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://s': FakeRelay('silent'), 'wss://h': FakeRelay('hold')})
+    async def publish():
+        async with RelayPool(relays) as pool:
+            start = time.monotonic()
+            results = await pool.publish({'id': 'aa'}, timeout=5, quorum=1)
+            return results, time.monotonic() - start, pool
+
+    results, elapsed, pool = run(publish())
+    assert elapsed < 1
+    assert results['wss://a'].accepted is True
+    assert results['wss://s'] == results['wss://h'] == (None, 'no reply', None)
+    assert pool.pending == {}
+
+def test_reconnect(relays):
+    relays['wss://a'] = FakeRelay('down')
+    async def publish():
+        async with RelayPool(relays) as pool:
+            relay = pool.relays['wss://a']
+            rv = [await pool.publish({'id': 'aa'}, timeout=1)]
+            # not retried before the backoff has passed
+            rv.append(await pool.publish({'id': 'aa'}, timeout=1))
+            assert relays['wss://a'].connects == 1 and relay.backoff == 1
+            relays['wss://a'].mode = 'accept'
+            relay.retry_at = 0
+            rv.append(await pool.publish({'id': 'aa'}, timeout=1))
+            assert relay.backoff == 0
+            # connection dropped by the relay is re-opened on the next send
+            relays['wss://a'].conn.close()
+            await asyncio.sleep(0.05)
+            rv.append(await pool.publish({'id': 'bb'}, timeout=1))
+            return [results['wss://a'] for results in rv]
+
+    results = run(publish())
+    assert results[0].message == 'error: connection refused'
+    assert results[1].message.startswith('error: reconnecting in')
+    assert results[2].accepted is True and results[3].accepted is True
+    assert relays['wss://a'].connects == 3
+
+def test_slow_relays(relays):
+    # connecting is not limited by a shared thread pool
+    for i in range(12):
+        relays[f'wss://slow{i}'] = FakeRelay('accept', handshake=0.5)
+    async def publish():
+        async with RelayPool(relays) as pool:
+            start = time.monotonic()
+            results = await pool.publish({'id': 'aa'}, timeout=5)
+            return results, time.monotonic() - start
+
+    results, elapsed = run(publish())
+    assert all(result.accepted for result in results.values())
+    assert elapsed < 1
+
+def test_blackholed_relay(relays):
+    # a relay that hangs while connecting does not hold up the others
+    relays.update({'wss://hole': FakeRelay('down', handshake=1), 'wss://a': FakeRelay('accept'), 'wss://b': FakeRelay('accept')})
+    async def publish():
+        async with RelayPool(relays) as pool:
+            return await asyncio.gather(*(pool.publish({'id': str(i)}, timeout=0.5) for i in range(10)))
+
+    results = run(publish())
+    assert sum(1 for per_relay in results for url in ('wss://a', 'wss://b') if per_relay[url].accepted) == 20
+    assert all(per_relay['wss://hole'].accepted is None for per_relay in results)
+    assert relays['wss://hole'].connects == 1
+
+def test_malformed_messages(relays, monkeypatch):
+    relays['wss://a'] = FakeRelay('accept')
+    async def publish():
+        async with RelayPool(relays) as pool:
+            rv = [await pool.publish({'id': 'aa'}, timeout=1)]
+            for garbage in [['OK', ['x'], True, ''], ['EVENT', {}, {}], ['OK'], ['EOSE'], {'OK': 1}, 'not json', ['OK', 'bb', True, 5]]:
+                relays['wss://a'].conn.replies.put(garbage if isinstance(garbage, str) else json.dumps(garbage))
+            # a message handler that fails does not end the connection either
+            handle = pool._on_message
+            def failing(relay, message):
+                if message == ['NOTICE', 'boom']:
+                    raise RuntimeError('boom')
+                handle(relay, message)
+            pool.relays['wss://a'].on_message = failing
+            relays['wss://a'].conn.replies.put(json.dumps(['NOTICE', 'boom']))
+            rv.append(await pool.publish({'id': 'bb'}, timeout=1))
+            return [results['wss://a'] for results in rv]
+
+    results = run(publish())
+    assert results[0].accepted is True and results[1].accepted is True
+    assert relays['wss://a'].connects == 1
+
+def test_send_to_relays_outbox(relays, tmp_path):
+    from nostr.client import send_to_relays
+    from nostr.outbox import Outbox
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://d': FakeRelay('down')})
+    path = tmp_path / 'outbox.sqlite'
+    results = send_to_relays(list(relays), {'id': 'aa'}, timeout=1, outbox=path)
+    assert results['wss://a'].accepted is True
+    assert Outbox(path, None).pending() == {'aa': ['wss://d']}
+
+    # the next run retries due deliveries in the background, without waiting
+    # for them before returning
+    relays['wss://d'] = FakeRelay('down', handshake=1)
+    start = time.monotonic()
+    send_to_relays(['wss://a'], {'id': 'bb'}, timeout=1, outbox=path)
+    assert time.monotonic() - start < 0.5
+    assert relays['wss://d'].connects == 1
+    assert Outbox(path, None).pending() == {'aa': ['wss://d']}
+
+def test_publish_many(relays):
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://h': FakeRelay('hold'), 'wss://s': FakeRelay('silent')})
+    events = [{'id': str(i)} for i in range(10)]
+    async def publish():
+        async with RelayPool(relays) as pool:
+            task = asyncio.create_task(pool.publish_many(events, window=4, timeout=1))
+            await asyncio.sleep(0.2)
+            # relays that don't answer have a full window outstanding
+            assert len(relays['wss://a'].sent('EVENT')) == 10
+            assert len(relays['wss://h'].sent('EVENT')) == 4
+            assert len(relays['wss://s'].sent('EVENT')) == 4
+            relays['wss://h'].release()
+            return await task, pool
+
+    (results, rates), pool = run(publish())
+    assert all(results[event['id']]['wss://a'].accepted for event in events)
+    assert all(results[event['id']]['wss://h'].accepted for event in events)
+    # the silent relay is given up on after three timeouts; a slot freed by
+    # one of the first two can still be used
+    sent = len(relays['wss://s'].sent('EVENT'))
+    assert 4 <= sent <= 6
+    assert [results[event['id']]['wss://s'].message for event in events] == ['no reply'] * sent + ['not sent: relay not responding'] * (10 - sent)
+    assert rates['wss://a'] > rates['wss://h'] > 0 and rates['wss://s'] == 0
+    assert pool.metrics.summary()['wss://s']['timeouts'] == sent
+    assert pool.pending == {}
+
+def test_publish_many_dead_relay(relays):
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://s': FakeRelay('silent')})
+    events = [{'id': str(i)} for i in range(100)]
+    async def publish():
+        async with RelayPool(relays) as pool:
+            start = time.monotonic()
+            results, _ = await pool.publish_many(events, window=10, timeout=0.3)
+            return results, time.monotonic() - start
+
+    results, elapsed = run(publish())
+    # not 100 / 10 windows * 0.3s
+    assert elapsed < 1
+    assert all(results[event['id']]['wss://a'].accepted for event in events)
+    assert all(results[event['id']]['wss://s'].accepted is None for event in events)
+    assert 10 <= len(relays['wss://s'].sent('EVENT')) <= 12
+
+def test_subscribe(relays):
+    relays.update({
+        'wss://a': FakeRelay(events=[{'id': '1'}, {'id': '2'}]),
+        'wss://b': FakeRelay(events=[{'id': '2'}, {'id': '3'}, 'garbage']),
+        'wss://c': FakeRelay(close_subs=True),
+        'wss://d': FakeRelay('down'),
+    })
+    async def subscribe():
+        async with RelayPool(relays) as pool:
+            events = [event async for event in pool.subscribe([{'kinds': [1]}], until_eose=True, sub_id='sub')]
+            # closing the generator early also CLOSEs the subscription
+            sub = pool.subscribe([{'kinds': [1]}], relays=['wss://a'], sub_id='sub2')
+            first = await sub.__anext__()
+            await sub.aclose()
+            return events, first, pool
+
+    events, first, pool = run(subscribe())
+    assert sorted(event['id'] for event in events) == ['1', '2', '3']
+    assert first == {'id': '1'}
+    assert relays['wss://a'].sent('REQ')[0] == ['REQ', 'sub', {'kinds': [1]}]
+    # CLOSE only where the subscription is still open
+    assert relays['wss://a'].sent('CLOSE') == [['CLOSE', 'sub'], ['CLOSE', 'sub2']]
+    assert relays['wss://b'].sent('CLOSE') == [['CLOSE', 'sub']]
+    assert relays['wss://c'].sent('CLOSE') == []
+    assert pool.subscriptions == {}
+
+def test_subscribe_disconnect(relays):
+    relays.update({'wss://a': FakeRelay(events=[{'id': '1'}]), 'wss://b': FakeRelay(events=[{'id': '2'}])})
+    async def subscribe():
+        async with RelayPool(relays) as pool:
+            events = []
+            async for event in pool.subscribe([{'kinds': [1]}], sub_id='sub'):
+                events.append(event)
+                if len(events) == 2:
+                    # a dropped connection ends the subscription on that relay
+                    relays['wss://a'].conn.close()
+                    relays['wss://b'].conn.close()
+            return events
+
+    assert sorted(event['id'] for event in run(subscribe())) == ['1', '2']
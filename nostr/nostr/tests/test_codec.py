@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from nostr.codec import CODECS, decode_message, get_codec
+from nostr.event import Event
+from nostr.key import NostrKey, compute_event_hash, verify_event
+
+def make_event():
+    key = NostrKey('01' * 32)
+    event = {
+        'pubkey': key.public_key,
+        'created_at': 1731409010,
+        'kind': 1,
+        'tags': [['t', 'test'], ['e', '00' * 32, '', 'root']],
+        'content': 'quotes " backslash \\ newline \n tab \t nul \x00 del \x7f unicode é 🧲  ',
+    }
+    key.sign_event(event)
+    return event
+
+@pytest.mark.parametrize('name', list(CODECS))
+def test_codec(name):
+    codec = get_codec(name)
+    event = make_event()
+    message = ['EVENT', 'sub', event]
+    # relays may send any valid JSON encoding, not just the canonical one
+    for data in [json.dumps(message), json.dumps(message, ensure_ascii=False), codec.dumps(message)]:
+        decoded = decode_message(data, codec)
+        assert decoded == message
+        assert compute_event_hash(decoded[2]) == event['id']
+        if isinstance(data, str):
+            assert decode_message(data.encode(), codec) == message
+
+    decoded = decode_message(codec.dumps(message), codec, Event)
+    assert isinstance(decoded[2], Event)
+    assert decoded[2].to_dict() == event
+    assert verify_event(decoded[2])
+    assert json.loads(codec.dumps(['EVENT', decoded[2]])) == ['EVENT', event]
+
+    # beyond what the fast backends handle natively
+    assert decode_message(codec.dumps(['COUNT', 'sub', {'count': 2**70}]), codec) == ['COUNT', 'sub', {'count': 2**70}]
+    assert decode_message(json.dumps(['EOSE', 'sub']), codec, Event) == ['EOSE', 'sub']
+
+    for garbage in ['', '["EVENT"', b'\xff', '["EVENT", "sub", {"kind": 1}]']:
+        with pytest.raises(ValueError):
+            decode_message(garbage, codec, Event)
+    with pytest.raises(TypeError):
+        codec.dumps([object()])
+
+def test_get_codec():
+    assert get_codec().name in CODECS
+    with pytest.raises(ValueError):
+        get_codec('yaml')
@@ -0,0 +1,57 @@
+import json
+import pickle
+
+import pytest
+
+from nostr.event import Event
+from nostr.key import NostrKey, compute_event_hash, verify_event
+
+def make_event(key):
+    return {
+        'pubkey': key.public_key,
+        'created_at': 1731409010,
+        'kind': 1,
+        'tags': [['t', 'test'], ['p', 'b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816', 'wss://relay.example.com']],
+        'content': "#test message 🧲",
+    }
+
+def test_round_trip():
+    key = NostrKey('01' * 32)
+    event = make_event(key)
+    key.sign_event(event)
+    event['custom'] = [1, 2]
+
+    compact = Event.from_dict(event)
+    assert compact.id == bytes.fromhex(event['id'])
+    assert compact.tags[0] == ('t', 'test')
+    assert compact.to_dict() == event
+    assert Event.from_json(compact.to_json()) == compact
+    assert Event.from_json(json.dumps(event)).to_dict() == event
+    assert pickle.loads(pickle.dumps(compact)) == compact
+    # tag strings are shared between events
+    assert Event.from_dict(json.loads(json.dumps(event))).tags[1][1] is compact.tags[1][1]
+
+    # unsigned
+    compact = Event.from_dict(make_event(key))
+    assert compact.id is None and 'id' not in compact and 'sig' not in compact.to_dict()
+
+    with pytest.raises(ValueError):
+        Event.from_dict(dict(event, id=event['id'].upper()))
+
+def test_sign_verify():
+    key = NostrKey('01' * 32)
+    event = make_event(key)
+    compact = Event.from_dict(event)
+    assert compute_event_hash(compact) == compute_event_hash(event)
+
+    key.sign_event(event)
+    key.sign_event(compact)
+    assert compact.to_dict() == event
+    assert verify_event(compact)
+    compact.sig = bytes(64)
+    assert not verify_event(compact)
+
+    compact = Event.from_dict(make_event(key))
+    result = key.sign_event(compact, difficulty=4, processes=1)
+    assert compact.tags[-1] == ('nonce', str(result.nonce), '4')
+    assert verify_event(compact)
@@ -1,3 +1,6 @@
+import hashlib
+import json
+
 from nostr.key import *
 
 def test_verify():
@@ -20,3 +23,120 @@ def test_verify():
     assert not verify_event(corrupted_event)
 
     assert verify_sig('b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816', '562ba36da0dd47b202e6c95c4aad2ba12997b8f86b2d353b08b4f0d59d179985', '1de8a6099df2d60aa7ed3471031a36fb97b7f091ef6c57b11f4346888d209902cb882274c0d448cd12c4f587eac65feae23c80bc27ea1530decae365cef7371c')
+
+def test_verify_events():
+    event = {
+        'pubkey': 'b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816',
+        'created_at': 1731409010,
+        'kind': 1,
+        'tags': ['t', 'test'],
+        'content': "#test message",
+        'id': '562ba36da0dd47b202e6c95c4aad2ba12997b8f86b2d353b08b4f0d59d179985',
+        'sig': '1de8a6099df2d60aa7ed3471031a36fb97b7f091ef6c57b11f4346888d209902cb882274c0d448cd12c4f587eac65feae23c80bc27ea1530decae365cef7371c',
+    }
+    corrupted_event = event.copy()
+    corrupted_event['content'] = 'fake'
+    malformed_event = event.copy()
+    del malformed_event['sig']
+
+    events = [event, corrupted_event, event, malformed_event]
+    expected = [True, False, True, False]
+    assert verify_events(events) == expected
+    assert verify_events(iter(events), processes=2) == expected
+    assert verify_events([]) == []
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1 # a is now most recently used
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+def test_serialize_event():
+    def reference(event):
+        data = [0, event['pubkey'], event['created_at'], event['kind'], event['tags'], event['content']]
+        return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+    pubkey = 'b7b4ee1454af66f017ef672cce681f37bafaee57ab1b899acc40176b2b537816'
+    contents = [
+        '',
+        '#test message',
+        'quote " backslash \\ slash /',
+        'newline \n tab \t cr \r backspace \b formfeed \f',
+        'control \x00 \x01 \x1f del \x7f',
+        'unicode ü € 𝄞 🧲     ﻿',
+    ]
+    tag_sets = [
+        [],
+        ['t', 'test'],
+        [['t', 'test'], ['p', pubkey, 'wss://nostr.x0f.org']],
+        [['file', f'bitcoin-28.0/bitcoin-28.0-{i}.tar.gz', str(i * 1000)] for i in range(300)],
+        [('t', 'tuple')],
+        [['nonce', '1', 20], ['x', None], []],
+        [[c] for c in contents],
+    ]
+    for content in contents:
+        for tags in tag_sets:
+            event = {'pubkey': pubkey, 'created_at': 1731409010, 'kind': 1, 'tags': tags, 'content': content}
+            assert serialize_event(event) == reference(event)
+            assert event_digest(event) == hashlib.sha256(reference(event)).digest()
+            assert compute_event_hash(event) == event_digest(event).hex()
+
+def test_sign_event_pow():
+    key = NostrKey('01' * 32)
+    event = {
+        'pubkey': key.public_key,
+        'created_at': 1731409010,
+        'kind': 1,
+        'tags': [['t', 'test'], ['nonce', '0', '1']],
+        'content': "#test message",
+    }
+    result = key.sign_event(event, difficulty=10, processes=1)
+    assert result.difficulty >= 10
+    assert event['tags'] == [['t', 'test'], ['nonce', str(result.nonce), '10']]
+    assert leading_zero_bits(bytes.fromhex(event['id'])) == result.difficulty
+    assert verify_event(event)
+
+    # parallel search, cut off by the deadline
+    result = mine_event(event, difficulty=256, timeout=0.5, processes=2)
+    assert 0 <= result.difficulty < 256
+    assert result.hashes > 0
+    assert leading_zero_bits(event_digest(event)) == result.difficulty
+
+def test_sign_events():
+    key = NostrKey('01' * 32)
+    def make_events():
+        return [{
+            'pubkey': key.public_key,
+            'created_at': 1731409010 + i,
+            'kind': 1,
+            'tags': [['t', 'test']],
+            'content': f"message {i}",
+        } for i in range(20)]
+
+    expected = make_events()
+    for event in expected:
+        key.sign_event(event)
+    assert key.sign_events(make_events(), workers=1) == expected
+    assert key.sign_events(make_events(), workers=4) == expected
+    assert key.sign_events(make_events(), workers=2, processes=True) == expected
+    assert all(verify_events(expected))
+
+def test_canonical_json(monkeypatch):
+    import nostr.key
+    data = [0, 'ü € 𝄞 🧲   quote " backslash \\ / \n\t\r\b\f \x00\x1f\x7f', 1731409010, 2**70, -1.5,
+            [['t', 'x', 20], [], ['x', None, True]], {'a': 'é'}]
+    functions = [nostr.key._canonical_json]
+    # fallbacks when the C encoder is missing or has a different signature
+    for c_make_encoder in [None, lambda *args: None]:
+        with monkeypatch.context() as m:
+            m.setattr(json.encoder, 'c_make_encoder', c_make_encoder)
+            functions.append(nostr.key._make_canonical_json())
+    assert functions[1] is not functions[0] and functions[2] is not functions[0]
+    for canonical_json in functions:
+        assert canonical_json(data).encode() == json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
@@ -0,0 +1,39 @@
+from nostr.metrics import *
+
+def test_histogram():
+    hist = Histogram()
+    assert hist.quantile(0.5) is None and hist.mean is None
+    for ms in range(1, 101):
+        hist.observe(ms / 1000)
+    assert hist.count == 100
+    assert abs(hist.mean - 0.0505) < 1e-9
+    assert hist.min == 0.001 and hist.max == 0.1
+    # bucket bounds: 0.032 < p50 <= 0.064, p99 capped at the maximum
+    assert hist.quantile(0.5) == 0.064
+    assert hist.quantile(0.99) == 0.1
+    assert hist.quantile(0) == 0.001
+
+    hist.observe(1000)
+    assert hist.quantile(1) == 1000
+
+def test_metrics():
+    seen = []
+    def bad_hook(url, name, value):
+        raise RuntimeError('ignored')
+    metrics = Metrics([lambda *args: seen.append(args), bad_hook])
+    metrics.observe('wss://a', 'connect', 0.25)
+    metrics.count('wss://a', 'bytes_sent', 300)
+    metrics.count('wss://a', 'accepted')
+    metrics.observe('wss://a', 'ok', 0.1)
+    metrics.count('wss://b', 'timeouts')
+    assert seen == [('wss://a', 'connect', 0.25), ('wss://a', 'bytes_sent', 300), ('wss://a', 'accepted', 1),
+                    ('wss://a', 'ok', 0.1), ('wss://b', 'timeouts', 1)]
+
+    summary = metrics.summary()
+    assert summary['wss://a']['bytes_sent'] == 300
+    assert summary['wss://a']['connect_mean'] == 0.25
+    assert summary['wss://a']['ok_p50'] == 0.1
+    assert summary['wss://b']['timeouts'] == 1
+    assert summary['wss://b']['ok_p50'] is None
+    report = metrics.report().splitlines()
+    assert len(report) == 3 and report[1].startswith('wss://a')
@@ -0,0 +1,80 @@
+import asyncio
+import time
+from collections import namedtuple
+
+from nostr.outbox import *
+
+Result = namedtuple('Result', ['accepted', 'message', 'rtt'])
+
+class FakePool:
+    def __init__(self, relays, replies, delay=0):
+        self.relays = {relay: None for relay in relays}
+        self.replies = replies
+        self.delay = delay
+        self.sent = []
+
+    async def publish_many(self, events, relays=None):
+        self.sent.append((relays, [event['id'] for event in events]))
+        await asyncio.sleep(self.delay)
+        return {event['id']: {relay: self.replies[relay] for relay in relays} for event in events}, {}
+
+def test_outbox(tmp_path):
+    path = tmp_path / 'outbox.sqlite'
+    event = {'id': 'aa', 'kind': 1}
+    pool = FakePool(['wss://a', 'wss://b', 'wss://c'], {
+        'wss://a': Result(True, '', 0.1),
+        'wss://b': Result(None, 'no reply', None),
+        'wss://c': Result(False, 'invalid: bad signature', 0.1),
+    }, delay=0.2)
+    outbox = Outbox(path, pool)
+    outbox.add(event)
+    outbox.add({'id': 'bb', 'kind': 1}, ['wss://b'])
+    assert outbox.pending() == {'aa': ['wss://a', 'wss://b', 'wss://c'], 'bb': ['wss://b']}
+
+    start = time.monotonic()
+    next_try = asyncio.run(outbox.flush(now=1000))
+    # one batch per relay, all relays at the same time
+    assert time.monotonic() - start < 0.4
+    assert sorted(pool.sent) == [(['wss://a'], ['aa']), (['wss://b'], ['aa', 'bb']), (['wss://c'], ['aa'])]
+    # accepted and permanently rejected relays are done, silent relay is retried later
+    assert outbox.pending() == {'aa': ['wss://b'], 'bb': ['wss://b']}
+    assert next_try == 1000 + RETRY_MIN
+    outbox.close()
+
+    # survives restart; nothing is due yet
+    outbox = Outbox(path, pool)
+    assert outbox.pending() == {'aa': ['wss://b'], 'bb': ['wss://b']}
+    asyncio.run(outbox.flush(now=next_try - 1))
+    assert len(pool.sent) == 3
+
+    pool.replies['wss://b'] = Result(True, '', 0.1)
+    assert asyncio.run(outbox.flush(now=next_try)) is None
+    assert pool.sent[-1] == (['wss://b'], ['aa', 'bb'])
+    assert outbox.pending() == {}
+    outbox.close()
+
+def test_outbox_run(tmp_path, monkeypatch):
+    import nostr.outbox
+    monkeypatch.setattr(nostr.outbox, 'RETRY_MIN', 0.1)
+    pool = FakePool(['wss://a', 'wss://b'], {
+        'wss://a': Result(True, '', 0.1),
+        'wss://b': Result(None, 'no reply', None),
+    })
+    async def run():
+        outbox = Outbox(tmp_path / 'outbox.sqlite', pool)
+        worker = asyncio.create_task(outbox.run())
+        await asyncio.sleep(0.05)
+        assert pool.sent == []
+        # adding an event wakes up the worker
+        outbox.add({'id': 'aa', 'kind': 1})
+        await asyncio.sleep(0.05)
+        assert outbox.pending() == {'aa': ['wss://b']}
+        pool.replies['wss://b'] = Result(True, '', 0.1)
+        # and the failed relay is retried after the delay
+        await asyncio.sleep(0.2)
+        assert outbox.pending() == {}
+        worker.cancel()
+        outbox.close()
+        return pool.sent
+
+    assert asyncio.run(run()) == [(['wss://a'], ['aa']), (['wss://b'], ['aa']), (['wss://b'], ['aa'])]
@@ -0,0 +1,68 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+
+import bencode
+from nostr.key import NostrKey
+from nostr.tests.test_client import FakeRelay, relays # noqa: F401 (fixture)
+
+spec = importlib.util.spec_from_file_location('post_torrent', os.path.join(os.path.dirname(__file__), '..', '..', 'post-torrent.py'))
+post_torrent = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(post_torrent)
+
+def make_torrents(base):
+    for i in range(3):
+        info = {b'name': f'name{i}'.encode(), b'piece length': 16384, b'pieces': bytes([i]) * 20, b'length': 1}
+        (base / f't{i}.torrent').write_bytes(bencode.bencode({b'announce': b'udp://tracker', b'info': info}))
+    # same torrent again, and torrents that are not valid
+    (base / 't3.torrent').write_bytes((base / 't0.torrent').read_bytes())
+    (base / 'nohash.torrent').write_bytes(bencode.bencode({b'info': {b'name': b'x', b'piece length': 16384, b'length': 1}}))
+    (base / 'garbage.torrent').write_bytes(b'garbage')
+    return post_torrent.find_torrents(str(base))
+
+def post(paths, state, relays):
+    args = argparse.Namespace(state=str(state), broadcast=True, metrics=False, store=None, pow=None, test=True,
+                              title=None, content=None, category=['application'], identifier=['tcat:test'])
+    asyncio.run(post_torrent.post_batch(paths, args, NostrKey('01' * 32), list(relays)))
+
+def sent_ids(relay):
+    return sorted(message[1]['id'] for message in relay.sent('EVENT'))
+
+def test_post_batch(relays, tmp_path, capsys):
+    paths = make_torrents(tmp_path)
+    state = tmp_path / 'post-torrent.test.state'
+    relays.update({'wss://a': FakeRelay('accept'), 'wss://d': FakeRelay('down')})
+    post(paths, state, relays)
+    assert capsys.readouterr().out.splitlines()[-1] == '6 torrents: 0 published, 1 already published, 3 failed on some relays, 2 invalid'
+    sent = sent_ids(relays['wss://a'])
+    assert len(sent) == 3 and sent_ids(relays['wss://d']) == []
+    records = [json.loads(line) for line in state.read_text().splitlines()]
+    assert sorted(record['event']['id'] for record in records) == sent
+    assert all(record['relays'] == ['wss://a'] for record in records)
+
+    # only the relay that failed gets the events, as they were signed before
+    relays['wss://d'] = FakeRelay('accept')
+    post(paths, state, relays)
+    assert capsys.readouterr().out.splitlines()[-1] == '6 torrents: 3 published, 1 already published, 0 failed on some relays, 2 invalid'
+    assert len(relays['wss://a'].sent('EVENT')) == 3
+    assert sent_ids(relays['wss://d']) == sent
+    state_ = post_torrent.load_state(state)
+    assert len(state_) == 3 and all(accepted == {'wss://a', 'wss://d'} for _, accepted in state_.values())
+
+    # everything was published, malformed records don't get in the way
+    with open(state, 'a') as f:
+        f.write('not json\n')
+        f.write(json.dumps({'hashes': [], 'event': {'id': 'x'}, 'relays': []}) + '\n')
+        f.write(json.dumps({'hashes': ['ab'], 'event': 'x', 'relays': []}) + '\n')
+    post(paths, state, relays)
+    out = capsys.readouterr().out.splitlines()
+    assert out[-1] == '6 torrents: 0 published, 4 already published, 0 failed on some relays, 2 invalid'
+    assert sum(1 for line in out if 'skipping malformed record' in line) == 3
+    assert len(relays['wss://a'].sent('EVENT')) == 3 and len(relays['wss://d'].sent('EVENT')) == 3
+
+    # a new relay gets everything
+    relays['wss://n'] = FakeRelay('accept')
+    post(paths, state, relays)
+    assert sent_ids(relays['wss://n']) == sent
@@ -0,0 +1,69 @@
+from nostr.event import Event
+from nostr.store import *
+
+def make_event(i, pubkey, kind, tags):
+    return {
+        'id': f'{i:064x}',
+        'pubkey': pubkey,
+        'created_at': 1731409000 + i,
+        'kind': kind,
+        'tags': tags,
+        'content': f'message {i} ü',
+        'sig': '00' * 64,
+    }
+
+ALICE = 'aa' * 32
+BOB = 'bb' * 32
+
+def test_store(tmp_path):
+    events = [
+        make_event(0, ALICE, 1, [['t', 'bitcoin'], ['p', BOB]]),
+        make_event(1, BOB, 1, [['t', 'nostr'], ['e', f'{0:064x}', '', 'mention']]),
+        make_event(2, ALICE, 30023, [['d', 'en-release-28.0'], ['t', 'bitcoin'], ['title', 'Bitcoin Core 28.0']]),
+        make_event(3, BOB, 2003, [['x', 'ff' * 20], ['file', 'a.tar.gz', '123']]),
+        make_event(4, ALICE, 1, []),
+    ]
+    path = tmp_path / 'events.sqlite'
+    store = EventStore(path, batch_size=10)
+    for event in events:
+        store.add(event)
+    assert events[4]['id'] in store # still in batch
+    assert store.flush() == 5
+    store.add(events[0]) # duplicate
+    assert store.flush() == 0
+    store.close()
+
+    store = EventStore(path)
+    def ids(filters):
+        return [int(event['id'], 16) for event in store.query(filters)]
+    assert store.get(events[2]['id']) == events[2]
+    assert store.get('00' * 32 + '11' * 32) is None
+    assert ids({}) == [4, 3, 2, 1, 0]
+    assert ids({'authors': [ALICE]}) == [4, 2, 0]
+    assert ids({'authors': [ALICE], 'kinds': [1]}) == [4, 0]
+    assert ids({'kinds': [1], 'limit': 2}) == [4, 1]
+    assert ids({'ids': [events[1]['id'], events[3]['id']]}) == [3, 1]
+    assert ids({'since': 1731409001, 'until': 1731409003}) == [3, 2, 1]
+    assert ids({'#t': ['bitcoin']}) == [2, 0]
+    assert ids({'#t': ['bitcoin', 'nostr'], 'authors': [BOB]}) == [1]
+    assert ids({'#d': ['en-release-28.0'], 'kinds': [30023]}) == [2]
+    assert ids({'#p': [BOB]}) == [0]
+    assert ids({'#x': ['ff' * 20]}) == [3]
+    assert ids({'#e': [f'{0:064x}']}) == [1]
+    assert ids({'authors': []}) == []
+    assert ids([{'kinds': [2003]}, {'#d': ['en-release-28.0']}, {'kinds': [2003, 1], 'limit': 1}]) == [4, 3, 2]
+    try:
+        store.query({'search': 'bitcoin'})
+        assert False
+    except ValueError:
+        pass
+    store.close()
+
+def test_store_event_objects(tmp_path):
+    events = [make_event(0, ALICE, 1, [['t', 'bitcoin'], ['p', BOB]]), make_event(1, BOB, 1, [])]
+    store = EventStore(tmp_path / 'events.sqlite')
+    store.add_many([Event.from_dict(events[0]), events[1]])
+    assert store.get(events[0]['id']) == events[0]
+    assert [event['id'] for event in store.query({'#t': ['bitcoin']})] == [events[0]['id']]
+    assert len(list(store.query({}))) == 2
+    store.close()
@@ -0,0 +1,183 @@
+import hashlib
+
+import bencode
+from torrent import compute_info_hash, load_torrent
+
+def test_compute_info_hash(tmp_path):
+    info = bencode.bencode({b'name': b'test', b'piece length': 16384, b'pieces': b'\x00' * 20, b'length': 10})
+    data = b'd8:announce9:udp://x:14:info' + info + b'e'
+    path = tmp_path / 'test.torrent'
+    path.write_bytes(data)
+    torrent = load_torrent(path)
+    assert torrent.raw(b'info') == info
+    assert data[slice(*torrent.span(b'info'))] == info
+    assert torrent[b'info'].span(b'length') == (data.index(b'i10e'), data.index(b'i10e') + 4)
+    assert compute_info_hash(torrent) == hashlib.sha1(info).hexdigest()
+    assert compute_info_hash(bencode.bdecode(data)) == hashlib.sha1(info).hexdigest()
+    assert str(torrent[b'info'][b'name'], 'utf-8') == 'test'
+
+    # info dictionary not in canonical order: only the original bytes give the
+    # hash that clients use
+    info = b'd4:name4:test6:lengthi10ee'
+    path.write_bytes(b'd4:info' + info + b'e')
+    assert compute_info_hash(load_torrent(path)) == hashlib.sha1(info).hexdigest()
+    assert compute_info_hash(bencode.bdecode(b'd4:info' + info + b'e')) != hashlib.sha1(info).hexdigest()
+
+def make_payload(base, sizes, piece_length):
+    '''
+    Write files of the given sizes (None for a padding file) under base/name
+    and return the info dict.
+    '''
+    data = b''
+    files = []
+    for i, size in enumerate(sizes):
+        if size is None:
+            size = piece_length - len(data) % piece_length
+            files.append({b'length': size, b'path': [b'.pad', str(size).encode()], b'attr': b'p'})
+            data += bytes(size)
+            continue
+        content = hashlib.sha256(str(i).encode()).digest() * (size // 32 + 1)
+        files.append({b'length': size, b'path': [b'dir', f'file{i}'.encode()]})
+        (base / 'name' / 'dir').mkdir(parents=True, exist_ok=True)
+        (base / 'name' / 'dir' / f'file{i}').write_bytes(content[:size])
+        data += content[:size]
+    pieces = b''.join(hashlib.sha1(data[i:i + piece_length]).digest() for i in range(0, len(data), piece_length))
+    return {b'name': b'name', b'piece length': piece_length, b'pieces': pieces, b'files': files}
+
+def test_verify_payload(tmp_path, monkeypatch):
+    import torrent
+    monkeypatch.setattr(torrent, 'VERIFY_TASK_SIZE', 64)
+    info = make_payload(tmp_path, [100, 0, 30, None, 16, 1, 200], 16)
+    files = torrent.payload_files(info, tmp_path)
+    assert [f.offset for f in files] == [0, 100, 100, 130, 144, 160, 161]
+    assert files[3].padding
+    assert [f.path for f in torrent.piece_files(files, 16, 6)] == [files[0].path, files[2].path]
+
+    for processes in [1, 2]:
+        result = torrent.verify_payload(info, tmp_path, processes=processes)
+        assert result.pieces == 23 and result.bad == [] and result.size == 361
+
+    # corrupt a byte in a piece spanning file0 and file2
+    path = tmp_path / 'name' / 'dir' / 'file2'
+    data = path.read_bytes()
+    path.write_bytes(b'x' + data[1:])
+    assert torrent.verify_payload(info, tmp_path, processes=2).bad == [6]
+    # truncated and missing files
+    path.write_bytes(data[:20])
+    assert torrent.verify_payload(info, tmp_path, processes=1).bad == [7, 8]
+    path.unlink()
+    assert torrent.verify_payload(info, tmp_path, processes=1).bad == [6, 7, 8]
+
+    # single file torrent
+    single = {b'name': b'file1', b'piece length': 16, b'pieces': hashlib.sha1(b'').digest(), b'length': 1}
+    (tmp_path / 'file1').write_bytes(b'a')
+    assert torrent.verify_payload(single, tmp_path).bad == [0]
+
+def naive_root(data, piece_length):
+    '''
+    Straightforward BEP 52 pieces root and piece layer over the whole file.
+    '''
+    leaves = [hashlib.sha256(data[i:i + 16384]).digest() for i in range(0, len(data), 16384)]
+    count = 1
+    while count < len(leaves):
+        count *= 2
+    layer = leaves + [bytes(32)] * (count - len(leaves))
+    piece_layer = None
+    blocks = 1
+    while len(layer) > 1:
+        if blocks == piece_length // 16384:
+            piece_layer = layer
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+        blocks *= 2
+    if blocks == piece_length // 16384:
+        piece_layer = layer
+    pieces = -(-len(data) // piece_length)
+    return layer[0], piece_layer[:pieces] if pieces > 1 else []
+
+def test_merkle_hasher():
+    import random
+    import torrent
+    rng = random.Random(0)
+    piece_length = 65536
+    for size in [1, 16384, 16385, 65536, 65537, 5 * 65536 + 100, 9 * 65536]:
+        data = rng.randbytes(size)
+        hasher = torrent.MerkleHasher(piece_length)
+        pos = 0
+        while pos < size:
+            n = rng.randrange(1, 40000)
+            hasher.update(data[pos:pos + n])
+            pos += n
+        assert hasher.finish() == naive_root(data, piece_length)
+    assert torrent.MerkleHasher(piece_length).finish() == (None, [])
+
+def test_v2(tmp_path):
+    import torrent
+    piece_length = 32768
+    contents = {'a.txt': b'hello', 'dir/b.bin': bytes(range(256)) * 1000, 'empty': b''}
+    tree = {}
+    layers = {}
+    for name, data in contents.items():
+        node = tree
+        for part in name.split('/'):
+            node = node.setdefault(part.encode(), {})
+        node[b''] = {b'length': len(data)}
+        if data:
+            root, layer = naive_root(data, piece_length)
+            node[b''][b'pieces root'] = root
+            if layer:
+                layers[root] = b''.join(layer)
+        (tmp_path / 'name' / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'name' / name).write_bytes(data)
+    info = {b'name': b'name', b'piece length': piece_length, b'meta version': 2, b'file tree': tree}
+    data = bencode.bencode({b'info': info, b'piece layers': layers})
+    (tmp_path / 'test.torrent').write_bytes(data)
+
+    t = load_torrent(tmp_path / 'test.torrent')
+    info_bytes = bencode.bencode(info)
+    assert torrent.info_hashes(t) == [hashlib.sha256(info_bytes).hexdigest()]
+    assert torrent.torrent_files(t[b'info']) == [('a.txt', 5), ('dir/b.bin', 256000), ('empty', 0)]
+    assert [f.path for f in torrent.tree_files(t[b'info'], 'base')] == ['base/name/a.txt', 'base/name/dir/b.bin', 'base/name/empty']
+
+    for processes in [1, 2]:
+        result = torrent.verify_payload_v2(t, tmp_path, processes=processes)
+        assert result.bad == [] and result.pieces == 9 and result.size == 256005
+    assert torrent.check_payload(t, tmp_path)
+
+    path = tmp_path / 'name' / 'dir' / 'b.bin'
+    path.write_bytes(contents['dir/b.bin'][:100000] + b'x' + contents['dir/b.bin'][100001:])
+    assert torrent.verify_payload_v2(t, tmp_path).bad == [(str(path), 3)]
+    (tmp_path / 'name' / 'a.txt').write_bytes(b'hellO')
+    path.write_bytes(b'short')
+    assert torrent.verify_payload_v2(t, tmp_path).bad == [(str(tmp_path / 'name' / 'a.txt'), None), (str(path), None)]
+    assert not torrent.check_payload(t, tmp_path)
+
+    # hybrid: both hashes, v1 first
+    hybrid = dict(info)
+    hybrid.update({b'pieces': bytes(20), b'length': 5})
+    assert torrent.info_hashes({b'info': hybrid}) == [hashlib.sha1(bencode.bencode(hybrid)).hexdigest(),
+                                                      hashlib.sha256(bencode.bencode(hybrid)).hexdigest()]
+
+def test_read_torrent_meta(tmp_path):
+    import pickle
+    from torrent import read_torrent_meta
+    info = {b'name': b'name', b'piece length': 16384, b'pieces': bytes(20), b'files': [
+        {b'length': 3, b'path': [b'dir', b'a']},
+        {b'length': 16381, b'path': [b'.pad', b'16381'], b'attr': b'p'},
+        {b'length': 1, b'path': [b'b']},
+    ]}
+    path = tmp_path / 'test.torrent'
+    path.write_bytes(bencode.bencode({b'announce-list': [[b'udp://b'], [b'udp://a', b'udp://b']], b'comment': b'c', b'info': info}))
+    meta = read_torrent_meta(path)
+    assert meta == pickle.loads(pickle.dumps(meta))
+    assert meta.info_hashes == [hashlib.sha1(bencode.bencode(info)).hexdigest()]
+    assert (meta.name, meta.comment) == ('name', 'c')
+    assert meta.files == [('dir/a', 3), ('b', 1)]
+    assert meta.trackers == ['udp://a', 'udp://b']
+
+def test_read_torrent_meta_no_hash(tmp_path):
+    import pytest
+    from torrent import read_torrent_meta
+    path = tmp_path / 'test.torrent'
+    path.write_bytes(bencode.bencode({b'info': {b'name': b'name', b'piece length': 16384, b'length': 1}}))
+    with pytest.raises(bencode.BTFailure):
+        read_torrent_meta(path)
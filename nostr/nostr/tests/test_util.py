@@ -12,3 +12,102 @@ def test_function():
     assert decode('npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl6') == {'hrp': 'npub', 'pubkey': bytes.fromhex('0aa39e5aef99a000a7bdb0b499158c92bc4aa20fb65931a52d055b5eb6dff738')}
     assert decode('nevent1qqsr46hsp2e8fl4whjdxfhp2knnzjj088wmu3vh8x50xwaaercftckqhhvjk2') == {'hrp': 'nevent', 'event_id': bytes.fromhex('3aeaf00ab274feaebc9a64dc2ab4e62949e73bb7c8b2e7351e6777b91e12bc58'), 'relays': []}
     assert decode('note10gvceh72dtwe9g2zscfmr6v75va9hd55uv8207g3g3ywknjaqrqs8rtr5w') == {'hrp': 'note', 'event_id': bytes.fromhex('7a198cdfca6add92a1428613b1e99ea33a5bb694e30ea7f9114448eb4e5d00c1')}
+
+def test_decode_many():
+    DECODE_CACHE.clear()
+    embeds = [
+        'nprofile1qqsq4gu7tthengqq577mpdyezkxf90z25g8mvkf355ks2k67km0lwwqpzdmhxue69uhkummnw3ezu7psvchx7un8zn5kcn',
+        'npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl6',
+        'nevent1qqsr46hsp2e8fl4whjdxfhp2knnzjj088wmu3vh8x50xwaaercftckqhhvjk2',
+        'note10gvceh72dtwe9g2zscfmr6v75va9hd55uv8207g3g3ywknjaqrqs8rtr5w',
+        'npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl7', # bad checksum
+        'naddr1qq8k2m3dwfjkcetpwdjj6v3c9ccqzymhwden5te0dehhxarj9eurqe3wdaexwq3qk76wu9z54an0q9l0vukvu6qlx7a04mjh4vdcnxkvgqtkk26n0qtqxpqqqp65w02s7av', # unsupported
+        'npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl6',
+    ]
+    for _ in range(2): # second time from cache
+        results = decode_many(embeds)
+        assert results[0] == Entity('nprofile', pubkey=bytes.fromhex('0aa39e5aef99a000a7bdb0b499158c92bc4aa20fb65931a52d055b5eb6dff738'), relays=('wss://nostr.x0f.org',))
+        assert results[1] == results[6] == Entity('npub', pubkey=bytes.fromhex('0aa39e5aef99a000a7bdb0b499158c92bc4aa20fb65931a52d055b5eb6dff738'))
+        assert results[2] == Entity('nevent', event_id=bytes.fromhex('3aeaf00ab274feaebc9a64dc2ab4e62949e73bb7c8b2e7351e6777b91e12bc58'), relays=())
+        assert results[3] == Entity('note', event_id=bytes.fromhex('7a198cdfca6add92a1428613b1e99ea33a5bb694e30ea7f9114448eb4e5d00c1'))
+        assert isinstance(results[4], ValueError)
+        assert isinstance(results[5], ValueError)
+    assert DECODE_CACHE.hits == len(embeds)
+
+def test_tlv():
+    tlv = {0: [bytes(range(32))], 1: ['wss://nostr.x0f.org', 'wss://relay.damus.io'], 3: [b'']}
+    data = build_tlv(tlv)
+    assert bytes(data) == (bytes([0, 32]) + bytes(range(32)) + bytes([1, 19]) + b'wss://nostr.x0f.org' +
+                           bytes([1, 20]) + b'wss://relay.damus.io' + bytes([3, 0]))
+    records = list(iter_tlv(data))
+    assert [(t, bytes(v)) for t, v in records] == [(0, bytes(range(32))), (1, b'wss://nostr.x0f.org'), (1, b'wss://relay.damus.io'), (3, b'')]
+    assert all(v.obj is data for t, v in records) # no copies
+    assert parse_tlv(data) == {0: [bytes(range(32))], 1: [b'wss://nostr.x0f.org', b'wss://relay.damus.io'], 3: [b'']}
+
+    assert parse_tlv(b'') == {}
+    assert parse_tlv(data[:-1]) is None # truncated header
+    assert parse_tlv(data[:10]) is None # truncated value
+    try:
+        build_tlv({1: ['x' * 256]})
+        assert False
+    except ValueError:
+        pass
+
+def test_embeds_to_tags_chunked():
+    content = ('[test] Merged PR from laanwj (nostr:nprofile1qqsq4gu7tthengqq577mpdyezkxf90z25g8mvkf355ks2k67km0lwwqpzdmhxue69uhkummnw3ezu7psvchx7un8zn5kcn nostr:npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl6): pr2 ' +
+               '<nostr:nevent1qqsx4e0dsr3srcf0k45pgryhvdgu47wld0f7ylg5lg3tqfs7snmfs9cpzdmhxue69uhkummnw3ezu7psvchx7un8qy28wumn8ghj7un9d3shjtnyv9kh2uewd9hsz9thwden5te0wp6hyurvv4ex2mrp0yhxxmmd35rvfv> ' +
+               'nostr:npub1p23eukh0nxsqpfaakz6fj9vvj27y4gs0kevnrffdq4d4adkl7uuq7crnl6 nostr:npub1invalid')
+    expected = embeds_to_tags(content)
+    assert len(expected[0]) == 2
+    for size in [1, 2, 5, 7, 64, 1000]:
+        chunks = [content[i:i + size] for i in range(0, len(content), size)]
+        assert embeds_to_tags(chunks) == expected
+        assert embeds_to_tags(iter(chunks)) == expected
+        assert list(iter_embeds(chunks)) == EMBED_RE.findall(content)
+    assert embeds_to_tags([]) == ([], set())
+
+def test_filter_index():
+    import random
+    rng = random.Random(3)
+    authors = [f'{i:064x}' for i in range(20)]
+    def random_event(i):
+        return {
+            'id': f'{i + 1000:064x}',
+            'pubkey': rng.choice(authors),
+            'created_at': 1731409000 + rng.randrange(100),
+            'kind': rng.choice([0, 1, 3, 2003, 30023]),
+            'tags': [[rng.choice('ept'), rng.choice(authors)] for _ in range(rng.randrange(3))] + [['title', 'x']],
+            'content': '',
+        }
+    def random_filter():
+        filt = {}
+        for key in rng.sample(['ids', 'authors', 'kinds', '#p', '#t', 'since', 'until', 'limit'], rng.randrange(4)):
+            if key == 'ids':
+                filt[key] = [f'{rng.randrange(1000, 1200):064x}' for _ in range(rng.randrange(1, 20))]
+            elif key in ('authors', '#p', '#t'):
+                filt[key] = rng.sample(authors, rng.randrange(1, 5))
+            elif key == 'kinds':
+                filt[key] = rng.sample([0, 1, 3, 2003, 30023], rng.randrange(1, 3))
+            else:
+                filt[key] = 1731409000 + rng.randrange(100)
+        return filt
+
+    filters = {i: random_filter() for i in range(300)}
+    index = FilterIndex()
+    for key, filt in filters.items():
+        index.add(key, filt)
+    for key in range(0, 300, 3):
+        index.remove(key)
+        del filters[key]
+    index.add(1, {'kinds': [1]}) # replace
+    filters[1] = {'kinds': [1]}
+    assert len(index) == len(filters)
+
+    for i in range(200):
+        event = random_event(i)
+        expected = {key for key, filt in filters.items() if filter_matches(filt, event)}
+        assert index.match(event) == expected
+
+    assert filter_matches({}, random_event(0))
+    assert filter_matches({'#t': ['bitcoin'], 'kinds': [1]}, {'id': '', 'pubkey': '', 'created_at': 0, 'kind': 1, 'tags': [['t', 'bitcoin']]})
+    assert not filter_matches({'#t': ['bitcoin'], 'kinds': [1]}, {'id': '', 'pubkey': '', 'created_at': 0, 'kind': 1, 'tags': [['p', 'bitcoin']]})
@@ -3,55 +3,172 @@ General nostr encoding/decoding utilities.
 '''
 # W.J. van der Laan 2024
 # SPDX-License-Identifier: MIT
+import collections
 import re
 import struct
+import threading
+from typing import NamedTuple, Optional
 
 from . import bech32
 
 EMBED_RE = re.compile('nostr:([0-9a-z]+)')
+# All characters that can be part of an EMBED_RE match.
+EMBED_CHARS = 'nostr:0123456789abcdefghijklmnopqrstuvwxyz'
+
+class LRUCache:
+    '''
+    Bounded, thread-safe mapping that evicts the least recently used entry
+    when full. Counts lookup hits and misses.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+class Entity(NamedTuple):
+    '''
+    Decoded NIP-19 entity. Fields that are not part of the entity are None.
+    '''
+    hrp: str
+    pubkey: Optional[bytes] = None
+    event_id: Optional[bytes] = None
+    relays: Optional[tuple] = None
+
+# bech32 string -> Entity, or ValueError if it could not be decoded
+DECODE_CACHE = LRUCache(100000)
+
+def iter_tlv(data):
+    '''
+    Iterate over the (type, value) records of TLV data. Values are memoryview
+    slices of `data`, nothing is copied. Raises ValueError when a record
+    runs past the end of the data.
+    '''
+    view = memoryview(data)
+    end = len(view)
+    ptr = 0
+    while ptr < end:
+        if ptr + 2 > end:
+            raise ValueError('truncated tlv record header')
+        t = view[ptr]
+        l = view[ptr + 1]
+        ptr += 2
+        if ptr + l > end:
+            raise ValueError('truncated tlv record value')
+        yield (t, view[ptr:ptr + l])
+        ptr += l
 
 def parse_tlv(data):
+    '''
+    Parse TLV data into a dict of lists of values (memoryview slices) per
+    type. Returns None for malformed data.
+    '''
+    rv = {}
     try:
-        rv = {}
-        ptr = 0
-        while ptr < len(data):
-            t = data[ptr]
-            l = data[ptr + 1]
+        for t, v in iter_tlv(data):
             if t not in rv:
                 rv[t] = []
-            rv[t].append(data[ptr + 2:ptr + 2 + l])
-            ptr += 2 + l
-        return rv
-    except IndexError:
+            rv[t].append(v)
+    except ValueError:
         return None
+    return rv
 
-def encode_tlv(hrp, tlv):
-    data = bytes()
+def build_tlv(tlv):
+    '''
+    Serialize a dict of lists of values per type to TLV data. String values
+    are encoded as UTF-8. Returns a bytearray.
+    '''
+    records = []
+    size = 0
     for t, values in tlv.items():
         for v in values:
             if isinstance(v, str):
                 v = v.encode('utf-8')
-            data += bytes([t, len(v)]) + v
-    converted_bits = bech32.convertbits(data, 8, 5)
+            if len(v) > 255:
+                raise ValueError('tlv value too long')
+            records.append((t, v))
+            size += 2 + len(v)
+    data = bytearray(size)
+    ptr = 0
+    for t, v in records:
+        data[ptr] = t
+        data[ptr + 1] = len(v)
+        data[ptr + 2:ptr + 2 + len(v)] = v
+        ptr += 2 + len(v)
+    return data
+
+def encode_tlv(hrp, tlv):
+    converted_bits = bech32.convertbits_bytes(build_tlv(tlv), 8, 5)
     return bech32.bech32_encode(hrp, converted_bits, bech32.Encoding.BECH32)
 
+def iter_embeds(chunks):
+    '''
+    Iterate over the NIP-19 strings of `nostr:` embeds in text that arrives
+    as an iterable of chunks. Embeds split across chunks are found too.
+    '''
+    carry = ''
+    for chunk in chunks:
+        text = carry + chunk
+        # a match can only continue into the next chunk if it is part of the
+        # run of embed characters at the end, so hold that back
+        cut = len(text.rstrip(EMBED_CHARS))
+        for match in EMBED_RE.finditer(text, 0, cut):
+            yield match.group(1)
+        carry = text[cut:]
+    for match in EMBED_RE.finditer(carry):
+        yield match.group(1)
+
 def embeds_to_tags(content):
     '''
     Returns 'p' tags for embedded user profiles, and a set of relays extracted
     from nprofiles.
+
+    `content` is a string or an iterable of string chunks. The distinct
+    embeds are decoded together in one batch.
     '''
+    if isinstance(content, str):
+        content = (content,)
     tags = {}
     relays_out = set()
-    for match in EMBED_RE.finditer(content):
-        embed = match.group(1)
-        try:
-            rec = decode(embed)
-        except ValueError: # invalid embed, just move on
+    embeds = list(iter_embeds(content))
+    unique = list(dict.fromkeys(embeds))
+    decoded = dict(zip(unique, decode_many(unique)))
+    for embed in embeds:
+        rec = decoded[embed]
+        if isinstance(rec, ValueError): # invalid embed, just move on
             continue
 
-        pubkey = rec.get('pubkey', None)
-        event_id = rec.get('event_id', None)
-        relays = rec.get('relays', [])
+        pubkey = rec.pubkey
+        event_id = rec.event_id
+        relays = rec.relays or ()
 
         if pubkey is not None:
             if relays: # if relay supplied, specify the first one
@@ -80,7 +197,7 @@ def embeds_to_tags(content):
 def encode_npub(pubkey):
     if isinstance(pubkey, str):
         pubkey = bytes.fromhex(pubkey)
-    converted_bits = bech32.convertbits(pubkey, 8, 5)
+    converted_bits = bech32.convertbits_bytes(pubkey, 8, 5)
     return bech32.bech32_encode("npub", converted_bits, bech32.Encoding.BECH32)
 
 def encode_nprofile(h, relays=[]):
@@ -111,42 +228,79 @@ def encode_naddr(h, relays=[], author=None, kind=None):
         tlv[3] = [struct.pack('>I', kind)]
     return encode_tlv("naddr", tlv)
 
-def decode(embed):
+def decode_entity(hrp, data) -> Entity:
     '''
-    Decode public, non-deprecated NIP-19 data types.
+    Decode public, non-deprecated NIP-19 data types from bech32 HRP and
+    5-bit data values.
     '''
-    rv = {}
-    (hrp, data, spec) = bech32.bech32_decode(embed, 1000)
-    if hrp is None or data is None or spec is None:
-        raise ValueError('not valid bech32')
-    rv['hrp'] = hrp
-    data = bytes(bech32.convertbits(data, 5, 8, False))
+    data = bech32.convertbits_bytes(data, 5, 8, False)
+    if data is None:
+        raise ValueError('invalid bech32 padding')
 
     if hrp == 'nprofile':
         tlv = parse_tlv(data)
         if tlv is None or 0x00 not in tlv or len(tlv[0x00][0]) != 32:
             raise ValueError('no valid tlv, no key, or invalid-length key')
-        rv['pubkey'] = tlv[0x00][0]
-        rv['relays'] = [relay.decode('utf8') for relay in tlv.get(0x01, [])]
+        return Entity(hrp, pubkey=bytes(tlv[0x00][0]),
+                relays=tuple(str(relay, 'utf8') for relay in tlv.get(0x01, [])))
     elif hrp == 'npub':
         if len(data) != 32:
             raise ValueError('invalid npub data length')
-        rv['pubkey'] = data
+        return Entity(hrp, pubkey=data)
     elif hrp == 'note':
         if len(data) != 32:
             raise ValueError('invalid note data length')
-        rv['event_id'] = data
+        return Entity(hrp, event_id=data)
     elif hrp == 'nevent':
         tlv = parse_tlv(data)
         if tlv is None or 0x00 not in tlv or len(tlv[0x00][0]) != 32:
             raise ValueError('no valid tlv, no key, or invalid-length key')
-        rv['event_id'] = tlv[0x00][0]
-        rv['relays'] = [relay.decode('utf8') for relay in tlv.get(0x01, [])]
-        if 0x02 in tlv:
-            rv['pubkey'] = tlv[0x02][0]
+        return Entity(hrp, event_id=bytes(tlv[0x00][0]),
+                pubkey=bytes(tlv[0x02][0]) if 0x02 in tlv else None,
+                relays=tuple(str(relay, 'utf8') for relay in tlv.get(0x01, [])))
     else:
         raise ValueError(f'invalid hrp {hrp}')
 
+def decode(embed):
+    '''
+    Decode public, non-deprecated NIP-19 data types.
+    '''
+    (hrp, data, spec) = bech32.bech32_decode_bytes(embed, 1000)
+    if hrp is None or data is None or spec is None:
+        raise ValueError('not valid bech32')
+    rv = {}
+    for field, value in decode_entity(hrp, data)._asdict().items():
+        if value is not None:
+            rv[field] = list(value) if field == 'relays' else value
+    return rv
+
+def decode_many(embeds):
+    '''
+    Decode many NIP-19 strings. Returns a list with an Entity for each valid
+    string and a ValueError for each invalid one.
+
+    Results are cached by string, and the bech32 checksums of strings not in
+    the cache are verified in bulk.
+    '''
+    rv = []
+    misses = {}
+    for embed in embeds:
+        result = DECODE_CACHE.get(embed)
+        if result is None:
+            misses.setdefault(embed, []).append(len(rv))
+        rv.append(result)
+    if misses:
+        embeds = list(misses)
+        for embed, (hrp, data, spec) in zip(embeds, bech32.bech32_decode_many(embeds, 1000)):
+            try:
+                if hrp is None:
+                    raise ValueError('not valid bech32')
+                result = decode_entity(hrp, bytes(data))
+            except ValueError as e:
+                result = e.with_traceback(None)
+            DECODE_CACHE.put(embed, result)
+            for i in misses[embed]:
+                rv[i] = result
     return rv
 
 def find_tag(event, tag, idx):
@@ -158,3 +312,141 @@ def find_tag(event, tag, idx):
             else:
                 n += 1
     return None
+
+def event_tag_values(event):
+    '''
+    Return the set of (name, value) pairs of the tags of event.
+    '''
+    return {(tag[0], tag[1]) for tag in event['tags'] if len(tag) >= 2}
+
+class CompiledFilter(NamedTuple):
+    '''
+    NIP-01 filter with its lists turned into sets. Conditions that are not
+    part of the filter are None.
+    '''
+    ids: Optional[frozenset] = None
+    authors: Optional[frozenset] = None
+    kinds: Optional[frozenset] = None
+    tags: tuple = () # ((name, frozenset of values), ...)
+    since: Optional[int] = None
+    until: Optional[int] = None
+
+    def matches(self, event, tag_values=None) -> bool:
+        '''
+        Check if event matches. `tag_values` can be passed in if already
+        computed with event_tag_values.
+        '''
+        if self.ids is not None and event['id'] not in self.ids:
+            return False
+        if self.authors is not None and event['pubkey'] not in self.authors:
+            return False
+        if self.kinds is not None and event['kind'] not in self.kinds:
+            return False
+        if self.since is not None and event['created_at'] < self.since:
+            return False
+        if self.until is not None and event['created_at'] > self.until:
+            return False
+        if self.tags:
+            if tag_values is None:
+                tag_values = event_tag_values(event)
+            for name, values in self.tags:
+                if not any((name, value) in tag_values for value in values):
+                    return False
+        return True
+
+def compile_filter(filt) -> CompiledFilter:
+    '''
+    Compile a NIP-01 filter dict. `limit` is ignored, as it only applies to
+    stored events. Raises ValueError for unsupported filter keys.
+    '''
+    fields = {}
+    tags = []
+    for key, value in filt.items():
+        if key in ('ids', 'authors', 'kinds'):
+            fields[key] = frozenset(value)
+        elif key in ('since', 'until'):
+            fields[key] = value
+        elif key.startswith('#') and len(key) == 2:
+            tags.append((key[1], frozenset(value)))
+        elif key != 'limit':
+            raise ValueError(f'unsupported filter key {key}')
+    return CompiledFilter(tags=tuple(tags), **fields)
+
+def filter_matches(filt, event) -> bool:
+    return compile_filter(filt).matches(event)
+
+class FilterIndex:
+    '''
+    Set of NIP-01 filters, indexed to quickly find the ones that match an
+    event.
+
+    Each filter is put in an inverted index under one of its conditions: ids,
+    authors, a tag, or kinds, in that order of preference. An event is then
+    only checked against the filters found under its own id, pubkey, tags and
+    kind, plus the filters that have none of these conditions.
+    '''
+    def __init__(self):
+        # key -> (CompiledFilter, index, index values)
+        self.filters = {}
+        self.by_id = {}
+        self.by_author = {}
+        self.by_tag = {} # (name, value) -> keys
+        self.by_kind = {}
+        self.unindexed = set()
+
+    def add(self, key, filt):
+        '''
+        Add filter (a dict or CompiledFilter) under key, replacing any
+        filter with the same key.
+        '''
+        if key in self.filters:
+            self.remove(key)
+        if not isinstance(filt, CompiledFilter):
+            filt = compile_filter(filt)
+        if filt.ids is not None:
+            index, values = self.by_id, filt.ids
+        elif filt.authors is not None:
+            index, values = self.by_author, filt.authors
+        elif filt.tags:
+            name, tag_values = filt.tags[0]
+            index, values = self.by_tag, [(name, value) for value in tag_values]
+        elif filt.kinds is not None:
+            index, values = self.by_kind, filt.kinds
+        else:
+            index, values = None, ()
+        if index is None:
+            self.unindexed.add(key)
+        for value in values:
+            index.setdefault(value, set()).add(key)
+        self.filters[key] = (filt, index, values)
+
+    def remove(self, key):
+        filt, index, values = self.filters.pop(key)
+        if index is None:
+            self.unindexed.discard(key)
+        for value in values:
+            keys = index[value]
+            keys.discard(key)
+            if not keys:
+                del index[value]
+
+    def __len__(self):
+        return len(self.filters)
+
+    def match(self, event) -> set:
+        '''
+        Return the set of keys of the filters that match event.
+        '''
+        tag_values = event_tag_values(event)
+        candidates = set(self.unindexed)
+        for index, value in ((self.by_id, event['id']), (self.by_author, event['pubkey']), (self.by_kind, event['kind'])):
+            keys = index.get(value)
+            if keys:
+                candidates.update(keys)
+        if self.by_tag:
+            for tag_value in tag_values:
+                keys = self.by_tag.get(tag_value)
+                if keys:
+                    candidates.update(keys)
+        filters = self.filters
+        return {key for key in candidates if filters[key][0].matches(event, tag_values)}
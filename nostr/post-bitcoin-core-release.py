@@ -15,6 +15,8 @@ import yaml
 from nostr.key import NostrKey
 from nostr.util import encode_naddr, encode_nevent
 from nostr.client import send_to_relays
+from nostr.metrics import Metrics
+from nostr.store import EventStore
 
 def load_jekyll(source):
     '''
@@ -58,7 +60,12 @@ def parse_args():
     parser.add_argument('-p', dest='test', action='store_false', help="Run in production mode instead of test mode")
     parser.add_argument('-u', dest='update_mode', action='store_true', help="Use update mode instead of creation mode")
     parser.add_argument('-b', dest='broadcast', action='store_true', help="Broadcast to relays")
+    parser.add_argument('--pow', type=int, help="Mine NIP-13 proof of work with this difficulty")
+    parser.add_argument('--store', help="Save signed event to this local event store (SQLite)")
+    parser.add_argument('--metrics', action='store_true', help="Print per-relay latency statistics after broadcasting")
+    parser.add_argument('--outbox', metavar='PATH', help="Queue deliveries that failed in this outbox (SQLite), and retry the ones that are due")
     parser.add_argument('--time-delta', type=int, help="Add time delta to event")
+    parser.add_argument('--quorum', type=int, help="Stop waiting after this many relays accepted the event")
     parser.add_argument('source', help="Jekyll markdown file to source from")
 
     return parser.parse_args()
@@ -121,13 +128,23 @@ def main():
     if args.time_delta is not None:
         event['created_at'] += args.time_delta
 
-    key.sign_event(event)
+    pow_result = key.sign_event(event, difficulty=args.pow)
+    if pow_result is not None:
+        print(f'proof of work: {pow_result.difficulty} bits, {pow_result.hashrate:.0f} hashes/s')
     print('event size is', len(json.dumps(event)))
+    if args.store is not None:
+        store = EventStore(args.store)
+        store.add(event)
+        store.close()
     print('created', encode_nevent(event['id'], relays=RELAYS))
 
     if args.broadcast:
-        send_to_relays(RELAYS, event)
-        print(f'broadcasted to relays: {RELAYS}')
+        metrics = Metrics() if args.metrics else None
+        results = send_to_relays(RELAYS, event, quorum=args.quorum, metrics=metrics, outbox=args.outbox)
+        accepted = [relay for relay, result in results.items() if result.accepted]
+        print(f'accepted by {len(accepted)}/{len(RELAYS)} relays: {accepted}')
+        if metrics is not None:
+            print(metrics.report())
 
     print('addr', encode_naddr(metadata['id'], relays=RELAYS, author=event['pubkey'], kind=event['kind']))
 
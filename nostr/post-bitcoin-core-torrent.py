@@ -6,21 +6,16 @@ Auto-post bitcoin core torrent as a nostr note (https://github.com/nostr-protoco
 # SPDX-License-Identifier: MIT
 # uses built-in bencode implementation ported from python 2.7 code by Petru Paler
 import argparse
-import hashlib
 import json
 import os
+import sys
 
-import bencode
+from torrent import load_torrent, info_hashes, torrent_files, check_payload
 from nostr.key import NostrKey
 from nostr.util import encode_naddr, encode_nevent
 from nostr.client import send_to_relays
-
-def compute_info_hash(torrent):
-    '''
-    Compute the torrent "info hash" as used in magnet links.
-    '''
-    # from: https://stackoverflow.com/a/4173411
-    return hashlib.sha1(bencode.bencode(torrent[b'info'])).hexdigest()
+from nostr.metrics import Metrics
+from nostr.store import EventStore
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -28,6 +23,11 @@ def parse_args():
     )
     parser.add_argument('-p', dest='test', action='store_false', help="Run in production mode instead of test mode")
     parser.add_argument('-b', dest='broadcast', action='store_true', help="Broadcast to relays")
+    parser.add_argument('--pow', type=int, help="Mine NIP-13 proof of work with this difficulty")
+    parser.add_argument('--store', help="Save signed event to this local event store (SQLite)")
+    parser.add_argument('--metrics', action='store_true', help="Print per-relay latency statistics after broadcasting")
+    parser.add_argument('--outbox', metavar='PATH', help="Queue deliveries that failed in this outbox (SQLite), and retry the ones that are due")
+    parser.add_argument('--verify', metavar='DIR', help="Check the downloaded payload in this directory against the piece hashes first")
     parser.add_argument('torrent', help="Torrent file to load")
 
     return parser.parse_args()
@@ -45,39 +45,42 @@ def main():
 
     key = NostrKey(private_key)
 
-    with open(args.torrent, 'rb') as f:
-        torrent_data = f.read()
-    torrent = bencode.bdecode(torrent_data)
+    torrent = load_torrent(args.torrent)
     info = torrent[b'info']
-    info_hash = compute_info_hash(torrent)
-    print(f'hash {info_hash}')
+    # v1 and/or v2 info hash
+    hashes = info_hashes(torrent)
+    for info_hash in hashes:
+        print(f'hash {info_hash}')
+    if args.verify is not None and not check_payload(torrent, args.verify):
+        print('Payload does not match the torrent')
+        sys.exit(1)
 
     # use file mtime (wget sets this) from the torrent file as timestamp
     created_at = int(os.stat(args.torrent).st_mtime)
 
     # torrent comment as event content
-    content = torrent[b'comment'].decode('utf-8')
+    content = str(torrent[b'comment'], 'utf-8')
     if args.test:
         content = '# TEST\n\n' + content
 
     # build tags
     tags = [
         ['title', content],
-        ['x', info_hash],
+    ]
+    tags += [['x', info_hash] for info_hash in hashes]
+    tags += [
         ['t', 'application'],
         ['t', 'bitcoin'],
     ]
     # add file information
-    for file_info in info[b'files']:
-        file_name = (b'/'.join(file_info[b'path'])).decode('utf-8')
-        file_size = file_info[b'length']
+    for file_name, file_size in torrent_files(info):
         tags.append(['file', file_name, str(file_size)])
 
     # parse trackers from a list of lists into a set
     trackers = set()
     for announce_info in torrent[b'announce-list']:
         for tracker in announce_info:
-            trackers.add(tracker.decode('utf8'))
+            trackers.add(str(tracker, 'utf-8'))
 
     # add trackers
     for tracker in sorted(trackers):
@@ -92,13 +95,23 @@ def main():
     }
     #print(event)
 
-    key.sign_event(event)
+    pow_result = key.sign_event(event, difficulty=args.pow)
+    if pow_result is not None:
+        print(f'proof of work: {pow_result.difficulty} bits, {pow_result.hashrate:.0f} hashes/s')
     print('event size is', len(json.dumps(event)))
+    if args.store is not None:
+        store = EventStore(args.store)
+        store.add(event)
+        store.close()
     print('created', encode_nevent(event['id'], relays=RELAYS))
 
     if args.broadcast:
-        send_to_relays(RELAYS, event)
-        print(f'broadcasted to relays: {RELAYS}')
+        metrics = Metrics() if args.metrics else None
+        results = send_to_relays(RELAYS, event, metrics=metrics, outbox=args.outbox)
+        accepted = [relay for relay, result in results.items() if result.accepted]
+        print(f'accepted by {len(accepted)}/{len(RELAYS)} relays: {accepted}')
+        if metrics is not None:
+            print(metrics.report())
 
 if __name__ == '__main__':
     main()
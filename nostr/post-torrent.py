@@ -6,23 +6,28 @@ Auto-post torrent as a nostr note (https://github.com/nostr-protocol/nips/blob/m
 # SPDX-License-Identifier: MIT
 # uses built-in bencode implementation ported from python 2.7 code by Petru Paler
 import argparse
-import hashlib
+import asyncio
+import collections
+import concurrent.futures
+import glob
 import json
 import os
 import time
 import sys
 
-import bencode
+from torrent import load_torrent, read_torrent_meta, check_payload
 from nostr.key import NostrKey
 from nostr.util import encode_naddr, encode_nevent
-from nostr.client import send_to_relays
+from nostr.client import RelayPool, send_to_relays
+from nostr.metrics import Metrics
+from nostr.store import EventStore
 
-def compute_info_hash(torrent):
-    '''
-    Compute the torrent "info hash" as used in magnet links.
-    '''
-    # from: https://stackoverflow.com/a/4173411
-    return hashlib.sha1(bencode.bencode(torrent[b'info'])).hexdigest()
+# Maximum number of torrents waiting between two stages of the batch pipeline.
+BATCH_QUEUE = 64
+# Default files recording which relays accepted the torrents published in
+# batch mode, in production and test mode.
+STATE_FILE = 'post-torrent.state'
+TEST_STATE_FILE = 'post-torrent.test.state'
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -30,60 +35,53 @@ def parse_args():
     )
     parser.add_argument('-p', dest='test', action='store_false', help="Run in production mode instead of test mode")
     parser.add_argument('-b', dest='broadcast', action='store_true', help="Broadcast to relays")
+    parser.add_argument('--pow', type=int, help="Mine NIP-13 proof of work with this difficulty")
+    parser.add_argument('--store', help="Save signed event to this local event store (SQLite)")
+    parser.add_argument('--metrics', action='store_true', help="Print per-relay latency statistics after broadcasting")
+    parser.add_argument('--outbox', metavar='PATH', help="Queue deliveries that failed in this outbox (SQLite), and retry the ones that are due")
+    parser.add_argument('--verify', metavar='DIR', help="Check the downloaded payload in this directory against the piece hashes first")
     parser.add_argument('--title', help="Torrent title (defaults to torrent name)")
     parser.add_argument('--content', help="Torrent content (defaults to torrent comment or name)")
     parser.add_argument('--category', help="Add t category tag, example: application, movie, 4k", nargs='+', default=[])
     parser.add_argument('--identifier', help="Add i identifier tag, example: tcat:..., newznab:..., ", nargs='+', default=[])
-    parser.add_argument('torrent', help="Torrent file to load")
-
-    return parser.parse_args()
-
-def main():
-    args = parse_args()
-    if not args.category or not args.identifier:
-        print('Please specify at least one category and identifier')
-        sys.exit(1)
-    if args.test:
-        from auth.testkey import private_key, RELAYS
-        print('[running in test mode]')
-        test_prefix = '[test] '
-    else:
-        from auth.laanwjkey import private_key, RELAYS
-        print('[running in production mode]')
-        test_prefix = ''
-
-    key = NostrKey(private_key)
+    parser.add_argument('--state', help=f"Batch mode: file recording which relays accepted each torrent; torrents are only sent to the other relays (default: {STATE_FILE}, or {TEST_STATE_FILE} in test mode)")
+    parser.add_argument('torrent', help="Torrent file to load, or a directory or glob pattern to post all torrents in (batch mode)")
 
-    with open(args.torrent, 'rb') as f:
-        torrent_data = f.read()
-    torrent = bencode.bdecode(torrent_data)
-    info = torrent[b'info']
-    info_hash = compute_info_hash(torrent)
-    print(f'hash {info_hash}')
+    args = parser.parse_args()
+    args.batch = os.path.isdir(args.torrent) or glob.has_magic(args.torrent)
+    if args.batch:
+        for option in ['title', 'content', 'verify', 'outbox']:
+            if getattr(args, option) is not None:
+                parser.error(f'--{option} cannot be used in batch mode')
+    return args
 
-    # use file mtime (wget sets this) from the torrent file as timestamp
-    #created_at = int(os.stat(args.torrent).st_mtime)
-    created_at = int(time.time())
+def find_torrents(spec):
+    '''
+    Return the torrent files in a directory, or matching a glob pattern.
+    '''
+    if os.path.isdir(spec):
+        spec = os.path.join(spec, '*.torrent')
+    return sorted(path for path in glob.glob(spec) if os.path.isfile(path))
 
-    torrent_name = info[b'name'].decode('utf-8') if b'name' in info else None
-    torrent_comment = torrent[b'comment'].decode('utf-8') if b'comment' in torrent else None
+def build_event(meta, args, public_key, created_at):
+    '''
+    Build the (unsigned) NIP-35 event for a torrent from its TorrentMeta.
+    '''
     # torrent name as title
     title = ''
     if args.title is not None:
         title = args.title
-    elif torrent_name is not None:
-        title = torrent_name
-    print(f'title {title}')
+    elif meta.name is not None:
+        title = meta.name
 
     # torrent comment as event content
     content = ''
     if args.content is not None:
         content = args.content
-    elif torrent_comment is not None:
-        content = torrent_comment
-    elif torrent_name is not None:
-        content = torrent_name
-    print(f'content {content}')
+    elif meta.comment is not None:
+        content = meta.comment
+    elif meta.name is not None:
+        content = meta.name
 
     # test mode
     if args.test:
@@ -93,8 +91,8 @@ def main():
     # build tags
     tags = [
         ['title', title],
-        ['x', info_hash],
     ]
+    tags += [['x', info_hash] for info_hash in meta.info_hashes]
     # add category tags
     for value in args.category:
         tags.append(['t', value])
@@ -102,37 +100,220 @@ def main():
     for value in args.identifier:
         tags.append(['i', value])
     # add file information
-    for file_info in info[b'files']:
-        file_name = (b'/'.join(file_info[b'path'])).decode('utf-8')
-        file_size = file_info[b'length']
+    for file_name, file_size in meta.files:
         tags.append(['file', file_name, str(file_size)])
-
-    # parse trackers from a list of lists into a set
-    trackers = set()
-    for announce_info in torrent[b'announce-list']:
-        for tracker in announce_info:
-            trackers.add(tracker.decode('utf8'))
-
     # add trackers
-    for tracker in sorted(trackers):
+    for tracker in meta.trackers:
         tags.append(['tracker', tracker])
 
-    event = {
-        'pubkey': key.public_key,
+    return {
+        'pubkey': public_key,
         'created_at': created_at,
         'kind': 2003,
         'tags': tags,
         'content': content,
     }
+
+def load_state(path):
+    '''
+    Read the state file, which has a JSON record per line with the info
+    hashes of a torrent, its signed event, and the relays that accepted it.
+    Returns a dict mapping info hash to `(event, set of relays)`, where the
+    relays of all records of the event are merged. Malformed records are
+    skipped.
+    '''
+    state = {}
+    try:
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    hashes, event, accepted = record['hashes'], record['event'], record['relays']
+                    if not hashes or not all(isinstance(item, str) for item in hashes + accepted + [event['id']]):
+                        raise ValueError('unexpected value')
+                except (ValueError, TypeError, KeyError):
+                    print(f'{path}:{number}: skipping malformed record')
+                    continue
+                entry = state.get(hashes[0])
+                if entry is None or entry[0]['id'] != event['id']:
+                    entry = (event, set())
+                entry[1].update(accepted)
+                for info_hash in hashes:
+                    state[info_hash] = entry
+    except FileNotFoundError:
+        pass
+    return state
+
+async def post_batch(paths, args, key, relays):
+    '''
+    Post many torrents through a pipeline of three stages connected by
+    bounded queues: parse and hash the torrent files in a process pool, build
+    and sign the events, and publish them over one set of relay connections.
+    Torrents in the state file are only sent again, with the event signed
+    before, to the relays that did not accept them yet. The relays that
+    accept an event are added to it.
+    '''
+    loop = asyncio.get_running_loop()
+    published = load_state(args.state)
+    parsed = asyncio.Queue(BATCH_QUEUE)
+    signed = asyncio.Queue(BATCH_QUEUE)
+    counts = collections.Counter()
+
+    async def parse_stage(executor):
+        slots = asyncio.Semaphore(BATCH_QUEUE) # torrents in the pool at once
+
+        async def parse(path):
+            try:
+                meta = await loop.run_in_executor(executor, read_torrent_meta, path)
+            except Exception as e:
+                print(f'{path}: cannot read torrent: {e}')
+                counts['invalid'] += 1
+            else:
+                await parsed.put(meta)
+            finally:
+                slots.release()
+
+        tasks = []
+        for path in paths:
+            await slots.acquire()
+            tasks.append(asyncio.create_task(parse(path)))
+        await asyncio.gather(*tasks)
+        await parsed.put(None)
+
+    async def sign_stage(store):
+        seen = set()
+        while True:
+            meta = await parsed.get()
+            if meta is None:
+                break
+            if any(info_hash in seen for info_hash in meta.info_hashes):
+                counts['skipped'] += 1
+                continue
+            seen.update(meta.info_hashes)
+            entry = next((published[info_hash] for info_hash in meta.info_hashes if info_hash in published), None)
+            if entry is not None:
+                event, accepted = entry
+                missing = [relay for relay in relays if relay not in accepted]
+                if not missing:
+                    counts['skipped'] += 1
+                    continue
+                print(f'{meta.path}: sending to {len(missing)} more relays')
+                await signed.put((meta, event, missing))
+                continue
+            event = build_event(meta, args, key.public_key, int(time.time()))
+            await asyncio.to_thread(key.sign_event, event, args.pow)
+            if store is not None:
+                store.add(event)
+            print(f'{meta.path}: created', encode_nevent(event['id'], relays=relays))
+            await signed.put((meta, event, relays))
+        await signed.put(None)
+
+    async def publish_stage(pool, state):
+        finished = False
+        while not finished:
+            # wait for one event, then take all that are ready and publish
+            # them together, pipelined per relay
+            batch = [await signed.get()]
+            while batch[-1] is not None and len(batch) < BATCH_QUEUE and not signed.empty():
+                batch.append(signed.get_nowait())
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if pool is None or not batch: # not broadcasting
+                continue
+            # one stream per set of target relays
+            groups = {}
+            for meta, event, targets in batch:
+                groups.setdefault(tuple(targets), []).append(event)
+            results = {}
+            for group_results, _ in await asyncio.gather(*(pool.publish_many(events, relays=list(targets)) for targets, events in groups.items())):
+                results.update(group_results)
+            for meta, event, targets in batch:
+                accepted = [relay for relay, result in results[event['id']].items() if result.accepted]
+                print(f'{meta.path}: accepted by {len(accepted)}/{len(targets)} relays')
+                if accepted:
+                    state.write(json.dumps({'hashes': meta.info_hashes, 'event': event, 'relays': accepted}) + '\n')
+                if len(accepted) == len(targets):
+                    counts['published'] += 1
+                else:
+                    counts['failed'] += 1
+            state.flush()
+
+    metrics = Metrics() if args.metrics else None
+    store = EventStore(args.store) if args.store is not None else None
+    try:
+        with concurrent.futures.ProcessPoolExecutor() as executor, open(args.state, 'a') as state:
+            if args.broadcast:
+                async with RelayPool(relays, metrics=metrics) as pool:
+                    await asyncio.gather(parse_stage(executor), sign_stage(store), publish_stage(pool, state))
+            else:
+                await asyncio.gather(parse_stage(executor), sign_stage(store), publish_stage(None, state))
+    finally:
+        if store is not None:
+            store.close()
+    print(f'{len(paths)} torrents: {counts["published"]} published, {counts["skipped"]} already published, '
+          f'{counts["failed"]} failed on some relays, {counts["invalid"]} invalid')
+    if metrics is not None:
+        print(metrics.report())
+
+def main():
+    args = parse_args()
+    if not args.category or not args.identifier:
+        print('Please specify at least one category and identifier')
+        sys.exit(1)
+    if args.test:
+        from auth.testkey import private_key, RELAYS
+        print('[running in test mode]')
+        test_prefix = '[test] '
+    else:
+        from auth.laanwjkey import private_key, RELAYS
+        print('[running in production mode]')
+        test_prefix = ''
+
+    key = NostrKey(private_key)
+
+    if args.batch:
+        if args.state is None:
+            args.state = TEST_STATE_FILE if args.test else STATE_FILE
+        paths = find_torrents(args.torrent)
+        print(f'posting {len(paths)} torrents')
+        asyncio.run(post_batch(paths, args, key, RELAYS))
+        return
+
+    meta = read_torrent_meta(args.torrent)
+    # v1 and/or v2 info hash
+    for info_hash in meta.info_hashes:
+        print(f'hash {info_hash}')
+    if args.verify is not None and not check_payload(load_torrent(args.torrent), args.verify):
+        print('Payload does not match the torrent')
+        sys.exit(1)
+
+    # use file mtime (wget sets this) from the torrent file as timestamp
+    #created_at = int(os.stat(args.torrent).st_mtime)
+    created_at = int(time.time())
+
+    event = build_event(meta, args, key.public_key, created_at)
     print(event)
 
-    key.sign_event(event)
+    pow_result = key.sign_event(event, difficulty=args.pow)
+    if pow_result is not None:
+        print(f'proof of work: {pow_result.difficulty} bits, {pow_result.hashrate:.0f} hashes/s')
     print('event size is', len(json.dumps(event)))
+    if args.store is not None:
+        store = EventStore(args.store)
+        store.add(event)
+        store.close()
     print('created', encode_nevent(event['id'], relays=RELAYS))
 
     if args.broadcast:
-        send_to_relays(RELAYS, event)
-        print(f'broadcasted to relays: {RELAYS}')
+        metrics = Metrics() if args.metrics else None
+        results = send_to_relays(RELAYS, event, metrics=metrics, outbox=args.outbox)
+        accepted = [relay for relay, result in results.items() if result.accepted]
+        print(f'accepted by {len(accepted)}/{len(RELAYS)} relays: {accepted}')
+        if metrics is not None:
+            print(metrics.report())
 
 if __name__ == '__main__':
     main()
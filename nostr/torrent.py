@@ -0,0 +1,442 @@
+'''
+Torrent file utilities shared by the posting scripts.
+'''
+# W.J. van der Laan 2024
+# SPDX-License-Identifier: MIT
+import bisect
+import concurrent.futures
+import hashlib
+import os
+import time
+from typing import NamedTuple, Optional
+
+import bencode
+
+def load_torrent(path):
+    '''
+    Decode a torrent file over a memory map (see bencode.bdecode_file).
+    String values are memoryviews; use bytes() or str(value, 'utf-8') to
+    convert them.
+    '''
+    return bencode.bdecode_file(path)
+
+def _info_bytes(torrent):
+    '''
+    The info dictionary exactly as it is encoded in the torrent file.
+    '''
+    if isinstance(torrent, bencode.LazyDict):
+        return torrent.raw(b'info')
+    # fully decoded torrent: re-encode, which is only correct if the info
+    # dictionary was in canonical (sorted) order
+    return bencode.bencode(torrent[b'info'])
+
+def compute_info_hash(torrent):
+    '''
+    Compute the torrent "info hash" as used in magnet links: the SHA-1 of
+    the info dictionary exactly as it is encoded in the torrent file.
+    '''
+    return hashlib.sha1(_info_bytes(torrent)).hexdigest()
+
+def compute_info_hash_v2(torrent):
+    '''
+    Compute the BitTorrent v2 (BEP 52) info hash: the SHA-256 of the info
+    dictionary.
+    '''
+    return hashlib.sha256(_info_bytes(torrent)).hexdigest()
+
+def is_v1(info):
+    return b'pieces' in info
+
+def is_v2(info):
+    return info.get(b'meta version') == 2 and b'file tree' in info
+
+def info_hashes(torrent):
+    '''
+    Return the info hashes of a torrent: the v1 hash, the v2 hash, or both
+    for a hybrid torrent.
+    '''
+    info = torrent[b'info']
+    rv = []
+    if is_v1(info):
+        rv.append(compute_info_hash(torrent))
+    if is_v2(info):
+        rv.append(compute_info_hash_v2(torrent))
+    return rv
+
+class TorrentMeta(NamedTuple):
+    '''
+    What is needed to announce a torrent, as plain values.
+    '''
+    path: str
+    info_hashes: list
+    name: Optional[str]
+    comment: Optional[str]
+    files: list # (path, length)
+    trackers: list
+
+def read_torrent_meta(path):
+    '''
+    Load a torrent file and return its TorrentMeta. The result can be
+    pickled, so this can run in a worker process. Raises BTFailure if the
+    torrent has no info hash.
+    '''
+    torrent = load_torrent(path)
+    info = torrent[b'info']
+    hashes = info_hashes(torrent)
+    if not hashes:
+        raise bencode.BTFailure('neither v1 pieces nor v2 file tree in info dictionary')
+    trackers = set()
+    if b'announce-list' in torrent:
+        for tier in torrent[b'announce-list']:
+            for tracker in tier:
+                trackers.add(str(tracker, 'utf-8'))
+    elif b'announce' in torrent:
+        trackers.add(str(torrent[b'announce'], 'utf-8'))
+    return TorrentMeta(
+        path=str(path),
+        info_hashes=hashes,
+        name=str(info[b'name'], 'utf-8') if b'name' in info else None,
+        comment=str(torrent[b'comment'], 'utf-8') if b'comment' in torrent else None,
+        files=torrent_files(info),
+        trackers=sorted(trackers),
+    )
+
+# Size of the byte range of the payload verified by one worker task.
+VERIFY_TASK_SIZE = 64 * 1024 * 1024
+
+class PayloadFile(NamedTuple):
+    '''
+    File of a torrent payload. `offset` is its position in the concatenated
+    payload. Padding files (BEP 47) are not on disk and read as zeros.
+    '''
+    path: str
+    offset: int
+    length: int
+    padding: bool = False
+
+class VerifyResult(NamedTuple):
+    pieces: int
+    bad: list
+    size: int
+    elapsed: float
+
+    @property
+    def rate(self):
+        '''
+        Verified bytes per second.
+        '''
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+def payload_files(info, base='.'):
+    '''
+    Return the list of PayloadFile of a torrent info dict, for a payload
+    downloaded into directory `base`.
+    '''
+    name = str(info[b'name'], 'utf-8')
+    if b'files' not in info: # single file
+        return [PayloadFile(os.path.join(base, name), 0, info[b'length'])]
+    rv = []
+    offset = 0
+    for file_info in info[b'files']:
+        path = os.path.join(base, name, *(str(part, 'utf-8') for part in file_info[b'path']))
+        padding = b'p' in bytes(file_info.get(b'attr', b''))
+        rv.append(PayloadFile(path, offset, file_info[b'length'], padding))
+        offset += file_info[b'length']
+    return rv
+
+def piece_files(files, piece_length, index):
+    '''
+    Return the files that piece `index` overlaps.
+    '''
+    start = index * piece_length
+    end = start + piece_length
+    return [f for f in files if f.offset < end and f.offset + f.length > start and f.length]
+
+def _read_at(handles, file, pos, view):
+    '''
+    Fill view with the contents of file starting at pos. Returns False if
+    the file is missing or too short.
+    '''
+    if file.padding:
+        view[:] = bytes(len(view))
+        return True
+    f = handles.get(file.path)
+    if f is None:
+        try:
+            f = handles[file.path] = open(file.path, 'rb', buffering=0)
+        except OSError:
+            return False
+    if f.tell() != pos:
+        f.seek(pos)
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            return False
+        filled += n
+    return True
+
+def _verify_range(files, piece_length, total, first, hashes):
+    '''
+    Verify consecutive pieces starting at index `first` against `hashes`,
+    their concatenated SHA-1 digests, reading from `files` (at least the
+    ones that overlap the pieces). Returns the indices of bad pieces.
+    Runs in a worker process.
+    '''
+    starts = [f.offset for f in files]
+    buf = memoryview(bytearray(piece_length))
+    handles = {}
+    bad = []
+    try:
+        for k in range(len(hashes) // 20):
+            index = first + k
+            start = index * piece_length
+            end = min(start + piece_length, total)
+            ok = True
+            # walk the files that overlap the piece, in payload order
+            i = bisect.bisect_right(starts, start) - 1
+            pos = start
+            while ok and pos < end:
+                file = files[i]
+                n = min(end, file.offset + file.length) - pos
+                if n > 0:
+                    ok = _read_at(handles, file, pos - file.offset, buf[pos - start:pos - start + n])
+                    pos += n
+                i += 1
+            if not ok or hashlib.sha1(buf[:end - start]).digest() != hashes[k * 20:k * 20 + 20]:
+                bad.append(index)
+    finally:
+        for f in handles.values():
+            f.close()
+    return bad
+
+def verify_payload(info, base='.', processes=None):
+    '''
+    Check the payload of a torrent in directory `base` against the piece
+    hashes of info dict. Pieces are read sequentially in large ranges and
+    hashed in a pool of `processes` worker processes (default: one per
+    core). Missing or truncated files make their pieces bad.
+    '''
+    start_time = time.time()
+    files = payload_files(info, base)
+    piece_length = info[b'piece length']
+    hashes = bytes(info[b'pieces'])
+    count = len(hashes) // 20
+    size = files[-1].offset + files[-1].length if files else 0
+    if count != -(-size // piece_length):
+        raise ValueError(f'torrent has {count} pieces for {size} bytes of payload')
+
+    # each task gets a contiguous range of pieces and only the files it needs
+    per_task = max(VERIFY_TASK_SIZE // piece_length, 1)
+    starts = [f.offset for f in files]
+    tasks = []
+    for first in range(0, count, per_task):
+        lo = max(bisect.bisect_right(starts, first * piece_length) - 1, 0)
+        hi = bisect.bisect_left(starts, (first + per_task) * piece_length)
+        tasks.append((files[lo:hi], piece_length, size, first, hashes[first * 20:(first + per_task) * 20]))
+    if processes is None:
+        processes = os.cpu_count()
+    if processes <= 1 or len(tasks) <= 1:
+        results = [_verify_range(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_verify_range, *zip(*tasks)))
+    return VerifyResult(count, [index for bad in results for index in bad], size, time.time() - start_time)
+
+# BitTorrent v2 (BEP 52): every file has its own merkle tree of SHA-256
+# hashes over 16 KiB blocks.
+BLOCK_SIZE = 16384
+# Size of the reads when hashing a file.
+READ_SIZE = 1 << 20
+
+class TreeFile(NamedTuple):
+    '''
+    File from a v2 file tree. `pieces_root` is None for empty files.
+    '''
+    path: str
+    length: int
+    pieces_root: bytes
+
+def _walk_tree(tree, parts):
+    for name, node in tree.items():
+        if name == b'': # file entry
+            root = node.get(b'pieces root')
+            yield parts, node[b'length'], bytes(root) if root is not None else None
+        else:
+            yield from _walk_tree(node, parts + [str(name, 'utf-8')])
+
+def tree_files(info, base='.'):
+    '''
+    Return the list of TreeFile of the `file tree` of a v2 info dict, for a
+    payload downloaded into directory `base`.
+    '''
+    tree = info[b'file tree']
+    files = list(_walk_tree(tree, []))
+    if len(files) == 1 and len(files[0][0]) == 1 and len(tree) == 1: # single file
+        prefix = [base]
+    else:
+        prefix = [base, str(info[b'name'], 'utf-8')]
+    return [TreeFile(os.path.join(*prefix, *parts), length, root) for parts, length, root in files]
+
+def torrent_files(info):
+    '''
+    Return (path, length) of the files in a v1, v2 or hybrid info dict, with
+    paths relative to the torrent directory. Padding files are skipped.
+    '''
+    if is_v2(info):
+        return [('/'.join(parts), length) for parts, length, _ in _walk_tree(info[b'file tree'], [])]
+    if b'files' not in info:
+        return [(str(info[b'name'], 'utf-8'), info[b'length'])]
+    return [(str(b'/'.join(f[b'path']), 'utf-8'), f[b'length']) for f in info[b'files']
+            if b'p' not in bytes(f.get(b'attr', b''))]
+
+def merkle_root(hashes, count, pad=bytes(32)):
+    '''
+    Root of a merkle tree with the given leaf hashes, padded with `pad` to
+    `count` leaves (a power of two).
+    '''
+    layer = list(hashes) + [pad] * (count - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+def _pow2(n):
+    return 1 << (n - 1).bit_length() if n > 1 else 1
+
+class MerkleHasher:
+    '''
+    Incremental BEP 52 hasher for one file. Feed the file contents with
+    update() in pieces of any size, then call finish(). Only the leaf hashes
+    of the current piece and the piece layer are kept in memory.
+    '''
+    def __init__(self, piece_length):
+        self.blocks_per_piece = piece_length // BLOCK_SIZE
+        self.block = bytearray()
+        self.leaves = [] # leaf hashes of the current piece
+        self.pieces = [] # piece layer
+
+    def _leaf(self, data):
+        self.leaves.append(hashlib.sha256(data).digest())
+        if len(self.leaves) == self.blocks_per_piece:
+            self.pieces.append(merkle_root(self.leaves, self.blocks_per_piece))
+            self.leaves = []
+
+    def update(self, data):
+        data = memoryview(data)
+        if self.block:
+            n = BLOCK_SIZE - len(self.block)
+            self.block += data[:n]
+            data = data[n:]
+            if len(self.block) < BLOCK_SIZE:
+                return
+            self._leaf(self.block)
+            self.block = bytearray()
+        end = len(data) - len(data) % BLOCK_SIZE
+        for i in range(0, end, BLOCK_SIZE):
+            self._leaf(data[i:i + BLOCK_SIZE])
+        self.block += data[end:]
+
+    def finish(self):
+        '''
+        Return `(pieces root, piece layer)`. The piece layer is the list of
+        piece hashes for files larger than one piece, as carried in the
+        torrent, and empty otherwise. Returns (None, []) for an empty file.
+        '''
+        if self.block: # the last block is hashed as is, without padding
+            self._leaf(self.block)
+            self.block = bytearray()
+        if not self.pieces:
+            if not self.leaves:
+                return None, []
+            return merkle_root(self.leaves, _pow2(len(self.leaves))), []
+        if self.leaves:
+            self.pieces.append(merkle_root(self.leaves, self.blocks_per_piece))
+            self.leaves = []
+        pad = merkle_root([], self.blocks_per_piece)
+        root = merkle_root(self.pieces, _pow2(len(self.pieces)), pad)
+        return root, self.pieces if len(self.pieces) > 1 else []
+
+def _verify_tree_file(file, piece_length, layer):
+    '''
+    Hash a file and check it against its pieces root and, if given, piece
+    layer. Returns the list of bad piece indices, or [None] if the file
+    is unreadable or its root does not match without a piece layer to
+    tell which pieces are bad. Runs in a worker process.
+    '''
+    hasher = MerkleHasher(piece_length)
+    buf = memoryview(bytearray(READ_SIZE))
+    size = 0
+    try:
+        with open(file.path, 'rb', buffering=0) as f:
+            while size < file.length:
+                n = f.readinto(buf[:min(READ_SIZE, file.length - size)])
+                if not n:
+                    break
+                hasher.update(buf[:n])
+                size += n
+    except OSError:
+        return [None]
+    if size < file.length:
+        return [None]
+    root, pieces = hasher.finish()
+    if root == file.pieces_root:
+        return []
+    if layer is None:
+        return [None]
+    expected = [layer[i:i + 32] for i in range(0, len(layer), 32)]
+    return [i for i, h in enumerate(pieces) if i >= len(expected) or h != expected[i]] or [None]
+
+def verify_payload_v2(torrent, base='.', processes=None):
+    '''
+    Check the payload of a v2 torrent in directory `base` against the merkle
+    roots of its files, and the `piece layers` to locate bad pieces. Files
+    are hashed in a pool of `processes` worker processes (default: one per
+    core), streaming with bounded memory. Bad pieces are reported as
+    (path, piece index within the file), or (path, None) if the file as a
+    whole failed.
+    '''
+    start_time = time.time()
+    info = torrent[b'info']
+    piece_length = info[b'piece length']
+    layers = torrent.get(b'piece layers', {})
+    files = [f for f in tree_files(info, base) if f.length]
+    tasks = []
+    for f in files:
+        layer = layers.get(f.pieces_root)
+        tasks.append((f, piece_length, bytes(layer) if layer is not None else None))
+    if processes is None:
+        processes = os.cpu_count()
+    if processes <= 1 or len(tasks) <= 1:
+        results = [_verify_tree_file(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(_verify_tree_file, *zip(*tasks)))
+    bad = [(f.path, index) for f, result in zip(files, results) for index in result]
+    pieces = sum(-(-f.length // piece_length) for f in files)
+    return VerifyResult(pieces, bad, sum(f.length for f in files), time.time() - start_time)
+
+def check_payload(torrent, base='.', processes=None):
+    '''
+    Verify the payload with verify_payload_v2 (v2 and hybrid torrents) or
+    verify_payload (v1 torrents) and print the outcome, including the files
+    with bad pieces. Returns True if all pieces are good.
+    '''
+    info = torrent[b'info']
+    bad_files = {}
+    if is_v2(info):
+        result = verify_payload_v2(torrent, base, processes)
+        for path, index in result.bad:
+            bad_files.setdefault(path, []).append(index)
+    else:
+        result = verify_payload(info, base, processes)
+        files = payload_files(info, base)
+        for index in result.bad:
+            for f in piece_files(files, info[b'piece length'], index):
+                bad_files.setdefault(f.path, []).append(index)
+    print(f'verified {result.pieces} pieces, {result.size / 2**20:.0f} MiB at {result.rate / 2**20:.0f} MiB/s: {len(result.bad)} bad')
+    for path, pieces in bad_files.items():
+        if pieces == [None]:
+            print(f'bad file {path}')
+        else:
+            print(f'bad pieces in {path}: {pieces}')
+    return not result.bad